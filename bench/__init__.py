@@ -0,0 +1 @@
+"""Benchmarks of the dashboard pages; run them from the repository root."""
@@ -0,0 +1,89 @@
+"""Import-time budget of the modules the dashboard pages import.
+
+Each measurement imports streamlit and then the page's ``ipa`` modules in a
+fresh interpreter with ``python -X importtime`` and reports the time spent
+importing ``ipa`` and its dependencies on top of streamlit. The fastest of
+``--repeat`` runs is compared with the budget, and the charting and geometry
+libraries that should only load when a figure or geometry is built must not
+have been imported at all.
+
+Run it from the repository root::
+
+    python -m bench.imports --budget-ms 800
+"""
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# what the page scripts import
+CORE_MODULES = ('ipa.instrument', 'ipa.ui', 'ipa.schemes', 'ipa.charts', 'ipa.figures', 'ipa.spatial')
+# imported only when a chart is drawn or geometry is rebuilt
+DEFERRED_MODULES = ('altair', 'plotly.express', 'plotly.graph_objects', 'shapely', 'rasterio')
+# pandas and pyarrow, which the cube needs on every run, take most of it
+BUDGET_MS = 800
+
+
+def _parse_importtime(stderr):
+    """``(name, cumulative microseconds, depth)`` of every import, in import order."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # nested imports are indented by two spaces per level below their importer
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(cumulative), depth))
+    return imports
+
+
+def measure(modules=CORE_MODULES):
+    """Import ``modules`` after streamlit in a fresh interpreter.
+
+    Returns
+    -------
+    dict
+        ``streamlit_ms`` and ``core_ms`` (import time on top of streamlit),
+        the ``heaviest`` top-level imports and the ``deferred`` modules that
+        were imported although they should not be.
+    """
+    # deferred modules streamlit itself imports do not count
+    code = ('import sys, streamlit; before = set(sys.modules); import ' + ', '.join(modules) + '; '
+            f'print(",".join(m for m in {DEFERRED_MODULES!r} if m in sys.modules and m not in before))')
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT_DIR,
+                         env=dict(os.environ, PYTHONPATH=ROOT_DIR), capture_output=True, text=True)
+    if out.returncode:
+        raise RuntimeError(out.stderr[-2000:])
+    imports = _parse_importtime(out.stderr)
+    # importtime lists a module after everything it imports
+    first_core = next(i for i, (name, _, depth) in enumerate(imports) if name == 'streamlit' and depth == 0) + 1
+    core = imports[first_core:]
+    return {'streamlit_ms': imports[first_core - 1][1] / 1000,
+            'core_ms': sum(us for _, us, depth in core if depth == 0) / 1000,
+            'heaviest': [(name, us) for name, us, depth in sorted(core, key=lambda i: -i[1])
+                         if not name.startswith('ipa')][:10],
+            'deferred': [m for m in out.stdout.strip().split(',') if m]}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=BUDGET_MS,
+                        help='allowed import time of the core modules on top of streamlit')
+    parser.add_argument('--repeat', type=int, default=5, help='measurements; the fastest is used')
+    args = parser.parse_args()
+
+    best = min((measure() for _ in range(args.repeat)), key=lambda m: m['core_ms'])
+    print(f"streamlit: {best['streamlit_ms']:8.1f} ms")
+    print(f"core:      {best['core_ms']:8.1f} ms (budget {args.budget_ms:.0f} ms)")
+    for name, us in best['heaviest']:
+        print(f'  {name:<40} {us / 1000:8.1f} ms')
+    failed = False
+    if best['deferred']:
+        print(f"imported eagerly: {', '.join(best['deferred'])}")
+        failed = True
+    if best['core_ms'] > args.budget_ms:
+        print('over budget')
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,141 @@
+"""Rerun latency of the dashboard pages on synthetic schemes of growing size.
+
+Every page and scheme size runs in a fresh process (``IPA_SCHEMES`` points it
+at the synthetic scheme) with Streamlit's ``AppTest``, and the script times
+the cold start (imports, data loading and the first run) and then every
+widget change the pages offer, each repeated and reported as the median.
+
+Run it from the repository root::
+
+    python -m bench.rerun --blocks 10 1000 10000 --years 6 40 --out results.json
+    python -m bench.rerun --baseline results.json   # flag regressions
+
+Results are JSON lines of ``{"page", "blocks", "years", "stage", "seconds"}``.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = ('Mwea_IPA_by_Sections.py', 'pages/Mwea_IPA_by_Blocks.py')
+# stage name -> selectbox label
+WIDGETS = {'year': 'Select a year', 'indicator': 'Select an indicator', 'stat': 'Select a statistics'}
+
+
+def _run_page(page, repeat, timeout):
+    """Time one page in this process; yields ``(stage, seconds)``."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(ROOT_DIR, page), default_timeout=timeout)
+
+    def timed_run(run):
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+        return seconds
+
+    yield 'cold', timed_run(at.run)
+    yield 'rerun', statistics.median(timed_run(at.run) for _ in range(repeat))
+    for stage, label in WIDGETS.items():
+        boxes = [s for s in at.selectbox if s.label == label]
+        if not boxes:
+            continue
+        options, first = boxes[0].options, boxes[0].value
+        times = []
+        for i in range(repeat):
+            # alternate between two options so every run is a change
+            option = options[1] if i % 2 == 0 else first
+            box = [s for s in at.selectbox if s.label == label][0]
+            times.append(timed_run(box.select(option).run))
+        yield stage, statistics.median(times)
+
+
+def run(page, n_blocks, n_years, work_dir, repeat=3, timeout=600, warm_up=False):
+    """Time one page on one synthetic scheme size in a fresh process.
+
+    Returns
+    -------
+    list of dict
+        One result per stage.
+    """
+    from bench.synthetic import make_scheme
+
+    registry = make_scheme(os.path.join(work_dir, f'{n_blocks}x{n_years}'), n_blocks, n_years)
+    env = dict(os.environ, IPA_SCHEMES=registry, IPA_FIGURE_WARM_UP='1' if warm_up else '0',
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT_DIR, os.environ.get('PYTHONPATH')])))
+    out = subprocess.run([sys.executable, '-m', 'bench.rerun', '--child', page,
+                          '--repeat', str(repeat), '--timeout', str(timeout)],
+                         cwd=ROOT_DIR, env=env, capture_output=True, text=True)
+    if out.returncode:
+        raise RuntimeError(f'{page} failed on {n_blocks} blocks x {n_years} years '
+                           f'(exit status {out.returncode}):\n{out.stderr[-2000:]}')
+    return [dict(page=page, blocks=n_blocks, years=n_years, **json.loads(line))
+            for line in out.stdout.splitlines() if line.startswith('{')]
+
+
+def compare(results, baseline, threshold=1.2):
+    """Results slower than ``threshold`` times their baseline, as ``(result, ratio)``."""
+    def key(r):
+        return r['page'], r['blocks'], r['years'], r['stage']
+
+    before = {key(r): r['seconds'] for r in baseline}
+    slower = []
+    for r in results:
+        if key(r) in before and r['seconds'] > threshold * before[key(r)]:
+            slower.append((r, r['seconds'] / before[key(r)]))
+    return slower
+
+
+def _read_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', nargs='*', default=list(PAGES), help='pages to time')
+    parser.add_argument('--blocks', type=int, nargs='*', default=[10, 100, 1000, 10000],
+                        help='numbers of blocks of the synthetic schemes')
+    parser.add_argument('--years', type=int, nargs='*', default=[6, 40],
+                        help='numbers of years of the synthetic schemes')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per widget change')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds allowed per run')
+    parser.add_argument('--warm-up', action='store_true', help='let the figure warm-up thread run')
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'ipa-bench'),
+                        help='where synthetic schemes are written and reused')
+    parser.add_argument('--out', help='write the results to this JSON lines file')
+    parser.add_argument('--baseline', help='JSON lines results to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='slowdown ratio reported as a regression')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        for stage, seconds in _run_page(args.child, args.repeat, args.timeout):
+            print(json.dumps({'stage': stage, 'seconds': round(seconds, 4)}), flush=True)
+        sys.exit()
+
+    results = []
+    print(f"{'page':<32} {'blocks':>6} {'years':>5} {'stage':<10} {'seconds':>8}")
+    for n_blocks in args.blocks:
+        for n_years in args.years:
+            for page in args.pages:
+                for r in run(page, n_blocks, n_years, args.work_dir, args.repeat, args.timeout, args.warm_up):
+                    results.append(r)
+                    print(f"{r['page']:<32} {r['blocks']:>6} {r['years']:>5} {r['stage']:<10} {r['seconds']:>8.3f}")
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.writelines(json.dumps(r) + '\n' for r in results)
+    if args.baseline:
+        slower = compare(results, _read_results(args.baseline), args.threshold)
+        for r, ratio in slower:
+            print(f"regression: {r['page']} {r['blocks']}x{r['years']} {r['stage']} {ratio:.2f}x slower")
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,263 @@
+"""Rerun latency and memory of many concurrent sessions of one dashboard server.
+
+Every page and number of sessions gets a fresh ``streamlit run`` server.
+Each simulated session is a browser-less client on its own thread that holds
+a websocket session with the server, as a browser tab does: it loads the
+page and then makes ``--steps`` random selections (mostly years and
+indicators, as analysts browse), sending the widget states a browser sends
+and timing each rerun until the server reports it finished. The sessions
+rerun at the same time, so the reported ``p50``, ``p95`` and ``max``
+latencies include the contention of concurrent sessions for the server's
+CPU and shared caches.
+
+One session loads the page first and stays connected, so that the shared
+data is loaded before the baseline memory is taken; the memory per session
+is the growth of the server's resident memory over that baseline with all
+sessions still connected, divided by their number. ``evictions`` counts the
+times the server dropped cached data for its memory budget.
+
+Run it from the repository root (the memory is read from ``/proc``, so on
+Linux)::
+
+    python -m bench.sessions --sessions 1 5 10 20 --steps 10
+    python -m bench.sessions --sessions 20 --budget-mb 1500 --container-mb 4096
+
+Results are JSON lines of ``{"page", "sessions", "reruns", "p50", "p95",
+"max", "baseline_mb", "rss_mb", "per_session_mb", "evictions"}``.
+"""
+import contextlib
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from bench.rerun import PAGES, ROOT_DIR, WIDGETS
+
+# how often analysts change each selection
+CHOICES = {'year': 4, 'indicator': 3, 'stat': 1.5, 'layer': 1.5}
+LAYER_WIDGET = 'Map layer'
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, round(q / 100 * (len(values) - 1)))]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _rss(pid):
+    with open(f'/proc/{pid}/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class Client:
+    """A browser-less session of a Streamlit server over its websocket.
+
+    Keeps the value of every selectbox and radio of the page, as the browser
+    does, and sends them all with every rerun.
+    """
+
+    def __init__(self, port, timeout):
+        from websockets.sync.client import connect
+
+        self.timeout = timeout
+        self._stack = contextlib.ExitStack()
+        self.ws = self._stack.enter_context(connect(
+            f'ws://127.0.0.1:{port}/_stcore/stream', subprotocols=['streamlit'],
+            origin=f'http://127.0.0.1:{port}', max_size=None, open_timeout=timeout))
+        # label -> (widget id, options); widget id -> selected option
+        self.widgets = {}
+        self.values = {}
+
+    def run(self):
+        """Rerun the page with the current widget values; returns the seconds until it finished."""
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        message = BackMsg()
+        message.rerun_script.query_string = ''
+        for widget_id, value in self.values.items():
+            message.rerun_script.widget_states.widgets.add(id=widget_id, string_value=value)
+        start = time.perf_counter()
+        self.ws.send(message.SerializeToString())
+        widgets = {}
+        while True:
+            msg = ForwardMsg()
+            msg.ParseFromString(self.ws.recv(timeout=self.timeout))
+            kind = msg.WhichOneof('type')
+            if kind == 'script_finished':
+                if msg.script_finished == ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    continue
+                elapsed = time.perf_counter() - start
+                break
+            if kind != 'delta' or msg.delta.WhichOneof('type') != 'new_element':
+                continue
+            element = msg.delta.new_element
+            element_type = element.WhichOneof('type')
+            if element_type == 'exception':
+                raise RuntimeError(f'{element.exception.type}: {element.exception.message}')
+            if element_type in ('selectbox', 'radio'):
+                widget = getattr(element, element_type)
+                widgets[widget.label] = (widget.id, list(widget.options))
+                if widget.id not in self.values:
+                    # a new widget, or one whose options changed, starts at its default
+                    self.values[widget.id] = widget.options[widget.default]
+        self.widgets = widgets
+        live = {widget_id for widget_id, _ in widgets.values()}
+        self.values = {k: v for k, v in self.values.items() if k in live}
+        return elapsed
+
+    def select(self, label, value):
+        self.values[self.widgets[label][0]] = value
+
+    def close(self):
+        self._stack.close()
+
+
+def _session(port, steps, seed, timeout, think, latencies):
+    """Load a page and make ``steps`` random selections; returns the connected client."""
+    rng = random.Random(seed)
+    client = Client(port, timeout)
+    latencies.append(client.run())
+    labels = dict(WIDGETS, layer=LAYER_WIDGET)
+    for _ in range(steps):
+        time.sleep(rng.uniform(0, 2 * think))
+        choice = rng.choices(list(CHOICES), list(CHOICES.values()))[0]
+        label = labels[choice]
+        client.select(label, rng.choice(client.widgets[label][1]))
+        latencies.append(client.run())
+    return client
+
+
+def _start_server(page, env, timeout):
+    port = _free_port()
+    # to a file, as a pipe nobody reads would block the server once full
+    log = tempfile.TemporaryFile()
+    server = subprocess.Popen([sys.executable, '-m', 'streamlit', 'run', page, '--server.headless', 'true',
+                               '--server.port', str(port), '--server.fileWatcherType', 'none',
+                               '--browser.gatherUsageStats', 'false'],
+                              cwd=ROOT_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            log.seek(0)
+            raise RuntimeError(f'the server of {page} exited with status {server.returncode}:\n'
+                               f'{log.read().decode()[-2000:]}')
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/_stcore/health', timeout=1):
+                return server, port
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f'the server of {page} did not start within {timeout} s')
+
+
+def _evictions(metrics_port):
+    with urllib.request.urlopen(f'http://127.0.0.1:{metrics_port}/metrics.json', timeout=5) as response:
+        stages = json.load(response)
+    return stages.get('enforce memory budget', {}).get('count', 0)
+
+
+def run(page, n_sessions, steps=10, timeout=600, think=0.0, budget_mb=None, registry=None):
+    """Run ``n_sessions`` concurrent sessions of a page against a fresh server.
+
+    Returns
+    -------
+    dict
+        Percentiles in seconds of the rerun latency (every run but the first
+        session's), the server's resident memory in MB and its memory budget
+        evictions.
+    """
+    metrics_port = _free_port()
+    env = dict(os.environ, IPA_FIGURE_WARM_UP='0', IPA_INSTRUMENT='1', IPA_METRICS_PORT=str(metrics_port),
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT_DIR, os.environ.get('PYTHONPATH')])))
+    if budget_mb:
+        env['IPA_MEMORY_BUDGET_MB'] = str(budget_mb)
+    if registry:
+        env['IPA_SCHEMES'] = registry
+    server, port = _start_server(page, env, timeout)
+    clients = []
+    try:
+        clients.append(_session(port, 0, 0, timeout, 0.0, []))
+        baseline = _rss(server.pid)
+        latencies, errors = [], []
+
+        def session(i):
+            try:
+                clients.append(_session(port, steps, i + 1, timeout, think, latencies))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=session, args=(i,), name=f'session-{i}') for i in range(n_sessions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        rss = _rss(server.pid)
+        evictions = _evictions(metrics_port)
+    finally:
+        for client in clients:
+            client.close()
+        server.terminate()
+        server.wait(timeout=30)
+    return {'page': page, 'sessions': n_sessions, 'reruns': len(latencies),
+            'p50': round(statistics.median(latencies), 4), 'p95': round(_percentile(latencies, 95), 4),
+            'max': round(max(latencies), 4), 'baseline_mb': round(baseline / 2 ** 20, 1),
+            'rss_mb': round(rss / 2 ** 20, 1), 'per_session_mb': round((rss - baseline) / 2 ** 20 / n_sessions, 2),
+            'evictions': evictions}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', nargs='*', default=list(PAGES), help='pages to simulate')
+    parser.add_argument('--sessions', type=int, nargs='*', default=[1, 5, 10, 20],
+                        help='numbers of concurrent sessions')
+    parser.add_argument('--steps', type=int, default=10, help='selections made by every session')
+    parser.add_argument('--think', type=float, default=0.0,
+                        help='mean seconds a session waits between selections')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds allowed per run')
+    parser.add_argument('--budget-mb', type=float, help='IPA_MEMORY_BUDGET_MB of the server')
+    parser.add_argument('--container-mb', type=float,
+                        help='estimate how many sessions fit in this much memory')
+    parser.add_argument('--blocks', type=int, help='simulate a synthetic scheme of this many blocks')
+    parser.add_argument('--years', type=int, default=6, help='years of the synthetic scheme')
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'ipa-bench'),
+                        help='where synthetic schemes are written and reused')
+    parser.add_argument('--out', help='write the results to this JSON lines file')
+    args = parser.parse_args()
+
+    registry = None
+    if args.blocks:
+        from bench.synthetic import make_scheme
+
+        registry = make_scheme(os.path.join(args.work_dir, f'{args.blocks}x{args.years}'), args.blocks, args.years)
+    results = []
+    print(f"{'page':<32} {'sessions':>8} {'reruns':>6} {'p50 s':>7} {'p95 s':>7} {'RSS MB':>7} "
+          f"{'MB/session':>10} {'evictions':>9}")
+    for page in args.pages:
+        for n_sessions in args.sessions:
+            r = run(page, n_sessions, args.steps, args.timeout, args.think, args.budget_mb, registry)
+            results.append(r)
+            print(f"{r['page']:<32} {r['sessions']:>8} {r['reruns']:>6} {r['p50']:>7.3f} {r['p95']:>7.3f} "
+                  f"{r['rss_mb']:>7.0f} {r['per_session_mb']:>10.2f} {r['evictions']:>9}")
+            if args.container_mb and r['per_session_mb'] > 0:
+                fit = (args.container_mb - r['baseline_mb']) / r['per_session_mb']
+                print(f"  ~{fit:.0f} sessions fit in {args.container_mb:.0f} MB at this rate")
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.writelines(json.dumps(r) + '\n' for r in results)
@@ -0,0 +1,131 @@
+"""Synthetic schemes of any size built from the Mwea data.
+
+A synthetic scheme tiles copies of the real block polygons side by side, so
+it has the real geometry, naming and section structure, and draws every
+block's yearly statistics from a real block's values with some noise. Each
+copy of the scheme gets its own section names (``Mwea-2``, ...) so the
+number of sections grows with the number of blocks.
+"""
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from ipa import data, geometry, store
+
+
+def _shift(coords, dx, dy):
+    if isinstance(coords[0], (int, float)):
+        return [coords[0] + dx, coords[1] + dy, *coords[2:]]
+    return [_shift(c, dx, dy) for c in coords]
+
+
+def _suffix(name, copy):
+    return name if copy == 0 else f'{name}-{copy}'
+
+
+def synthetic_blocks(n_blocks, blocks_path=data.BLOCKS_JSON):
+    """``n_blocks`` block polygons tiled from the real ones.
+
+    Returns
+    -------
+    geo : dict
+        Block polygons as a GeoJSON ``FeatureCollection``.
+    source : list of int
+        Index of the real block each synthetic block is a copy of.
+    center : dict
+        Centre of the tiled area.
+    zoom : float
+        Map zoom level showing the whole tiled area.
+    """
+    from shapely.geometry import shape
+    from shapely.ops import unary_union
+
+    real = data.load_blocks(blocks_path)
+    features = real['features']
+    west, south, east, north = unary_union([shape(f['geometry']) for f in features]).bounds
+    width, height = (east - west) * 1.05, (north - south) * 1.05
+    copies = math.ceil(n_blocks / len(features))
+    columns = math.ceil(math.sqrt(copies))
+    rows = math.ceil(copies / columns)
+
+    tiled, source = [], []
+    for i in range(n_blocks):
+        copy, j = divmod(i, len(features))
+        feat = features[j]
+        dx, dy = (copy % columns) * width, -(copy // columns) * height
+        props = dict(feat['properties'], fid=float(i + 1),
+                     block=_suffix(feat['properties']['block'], copy),
+                     section_name=_suffix(feat['properties']['section_name'], copy))
+        tiled.append(dict(feat, properties=props,
+                          geometry=dict(feat['geometry'], coordinates=_shift(feat['geometry']['coordinates'], dx, dy))))
+        source.append(j)
+
+    center = {"lat": (north + south) / 2 - (rows - 1) * height / 2,
+              "lon": (west + east) / 2 + (columns - 1) * width / 2}
+    zoom = 10.3 - math.log2(max(columns, rows))
+    return dict(real, features=tiled), source, center, zoom
+
+
+def synthetic_stats(geo, source, n_years, csv_path=data.STATS_CSV, seed=0):
+    """Wide statistics of ``n_years`` years ending with the last real year.
+
+    Every synthetic block takes the values of its real block in a real year,
+    cycling through the real years, scaled by up to about 10 % of noise.
+    """
+    real = data.load_stats(csv_path)
+    value_columns = [c for c in real.columns if c not in store.KEY_COLUMNS]
+    real_years = sorted(real['year'].unique())
+    by_block_year = real.set_index(['block', 'year'])[value_columns]
+    real_blocks = [f['properties']['block'] for f in data.load_blocks()['features']]
+    last = real_years[-1]
+    years = list(range(last - n_years + 1, last + 1))
+
+    names = [(f['properties']['section_name'], f['properties']['block']) for f in geo['features']]
+    rng = np.random.default_rng(seed)
+    frames = []
+    for k, year in enumerate(years):
+        real_year = real_years[k % len(real_years)]
+        keys = pd.MultiIndex.from_arrays([[real_blocks[j] for j in source], [real_year] * len(source)])
+        values = by_block_year.reindex(keys).to_numpy()
+        values = values * (1 + 0.05 * rng.standard_normal(values.shape))
+        frame = pd.DataFrame(values.round(4), columns=value_columns)
+        frame.insert(0, 'block', [b for _, b in names])
+        frame.insert(0, 'section_name', [s for s, _ in names])
+        frame.insert(0, 'year', year)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)[real.columns]
+
+
+def make_scheme(out_dir, n_blocks, n_years, seed=0):
+    """Write a synthetic scheme and its registry to ``out_dir``, preparing its store.
+
+    Returns
+    -------
+    str
+        Path of the scheme registry, for the ``IPA_SCHEMES`` environment variable.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    registry_path = os.path.join(out_dir, 'schemes.json')
+    if os.path.exists(registry_path):
+        return registry_path
+
+    geo, source, center, zoom = synthetic_blocks(n_blocks)
+    stats = synthetic_stats(geo, source, n_years, seed=seed)
+    csv_path = os.path.join(out_dir, 'stats.csv')
+    blocks_path = os.path.join(out_dir, 'blocks.json')
+    stats.to_csv(csv_path, index=False)
+    with open(blocks_path, 'w') as f:
+        json.dump(geo, f)
+    # the data preparation a deployment runs before serving
+    store.build_store(csv_path, f'{os.path.splitext(csv_path)[0]}.parquet')
+    geometry.load_sections(blocks_path, processes=None)
+
+    name = f'Synthetic {n_blocks}x{n_years}'
+    with open(registry_path, 'w') as f:
+        json.dump({"schemes": [{"id": "synthetic", "name": name, "title": name,
+                                "stats": 'stats.csv', "blocks": 'blocks.json',
+                                "center": center, "zoom": round(zoom, 2)}]}, f, indent=1)
+    return registry_path
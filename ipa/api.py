@@ -0,0 +1,236 @@
+"""Read-only HTTP API of the indicator data.
+
+Serves the values, year-over-year changes and histories behind the
+dashboard's maps and ranked tables to other systems, from the same cube the
+pages use, without a Streamlit session::
+
+    GET /schemes                          registered schemes
+    GET /schemes/<id>                     years, indicators, statistics and levels
+    GET /schemes/<id>/values?year=2021&indicator=seasonal_yield[&stat=mean][&level=block]
+    GET /schemes/<id>/deltas?year=2021&indicator=seasonal_yield[&stat=mean][&level=block][&lag=1]
+    GET /schemes/<id>/histories?indicator=seasonal_yield[&stat=mean][&level=block]
+
+Tables are returned as JSON records, or as an Arrow IPC stream with
+``format=arrow`` or ``Accept: application/vnd.apache.arrow.stream``.
+Responses are cached in memory under the data version they were built from,
+carry a content ``ETag`` (a matching ``If-None-Match`` is answered with an
+empty 304) and are gzip-compressed for clients that accept it.
+
+Usage::
+
+    python -m ipa.api [--port 8600] [--host 127.0.0.1] [--registry data/schemes.json]
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from ipa import instrument, memory, schemes
+from ipa.cube import LEVELS
+from ipa.figures import FigureCache
+
+ARROW_TYPE = 'application/vnd.apache.arrow.stream'
+JSON_TYPE = 'application/json'
+TABLES = ('values', 'deltas', 'histories')
+
+log = logging.getLogger('ipa.api')
+
+cache = FigureCache(int(os.environ.get('IPA_API_CACHE_SIZE', 256)))
+
+
+class ApiError(Exception):
+    """A request that cannot be answered, with its HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Response:
+    """A cached response body, its gzip-compressed form and its ETag."""
+    __slots__ = ('body', 'gzipped', 'content_type', 'etag')
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=6)
+        self.content_type = content_type
+        self.etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+
+
+def _json(obj):
+    return json.dumps(obj, separators=(',', ':'), allow_nan=False).encode()
+
+
+def _frame_json(df):
+    # to_json writes NaN as null
+    return df.to_json(orient='records', double_precision=6).encode()
+
+
+def _frame_arrow(df):
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _param(query, name, default=None, choices=None, convert=str):
+    values = query.get(name)
+    if not values:
+        if default is None:
+            raise ApiError(400, f'missing parameter {name!r}')
+        return default
+    try:
+        value = convert(values[-1])
+    except ValueError:
+        raise ApiError(400, f'invalid {name!r}: {values[-1]!r}') from None
+    if choices is not None and value not in choices:
+        raise ApiError(400, f'invalid {name!r}: {value!r}, expected one of {", ".join(map(str, choices))}')
+    return value
+
+
+def _indicators(cube):
+    return sorted({c.rsplit('_', 1)[0] for c in cube.columns})
+
+
+def _table(cube, table, query):
+    """The frame of one table request."""
+    level = _param(query, 'level', 'block', LEVELS)
+    indicator = _param(query, 'indicator', choices=_indicators(cube))
+    if table == 'histories':
+        stat = _param(query, 'stat', 'mean', cube.stats(indicator))
+        history = cube.history(level, indicator, stat).rename(columns=str).reset_index()
+        if level == 'block':
+            history.insert(0, 'section_name', history['block'].map(cube.section_of))
+        return history
+    year = _param(query, 'year', choices=cube.years, convert=int)
+    stat = _param(query, 'stat', 'mean', cube.stats(indicator, year))
+    if table == 'values':
+        return cube.values(level, year, indicator, stat)
+    # every lag is ranked and kept by the delta engine, so only the meaningful ones are accepted
+    lag = _param(query, 'lag', 1, choices=range(1, len(cube.years)), convert=int)
+    return cube.deltas.ranked(level, year, indicator, stat, lag=lag)
+
+
+def _build(opened, parts, query, arrow):
+    cube = opened.cube
+    if len(parts) == 2:
+        indicators = _indicators(cube)
+        scheme = opened.scheme
+        return Response(_json({'id': scheme.id, 'name': scheme.name, 'version': cube.version,
+                               'years': cube.years, 'levels': list(LEVELS), 'indicators': indicators,
+                               'stats': cube.stats(indicators[0])}),
+                        JSON_TYPE)
+    df = _table(cube, parts[2], query)
+    if arrow:
+        return Response(_frame_arrow(df), ARROW_TYPE)
+    return Response(_frame_json(df), JSON_TYPE)
+
+
+def respond(path, query, registry_path=schemes.REGISTRY, arrow=False):
+    """The response to a GET of ``path`` with the parsed ``query``.
+
+    Raises
+    ------
+    ApiError
+        For unknown paths and schemes (404) and invalid parameters (400),
+        such as a ``lag`` outside ``1`` to the number of years less one.
+    """
+    parts = [p for p in path.split('/') if p]
+    registered = schemes.registry(registry_path)
+    if parts == ['schemes']:
+        return Response(_json([{'id': s.id, 'name': s.name, 'title': s.title} for s in registered.values()]),
+                        JSON_TYPE)
+    if len(parts) not in (2, 3) or parts[0] != 'schemes' or (len(parts) == 3 and parts[2] not in TABLES):
+        raise ApiError(404, f'no such resource: {path}')
+    if parts[1] not in registered:
+        raise ApiError(404, f'no such scheme: {parts[1]}')
+    arrow = _param(query, 'format', 'arrow' if arrow else 'json', ('json', 'arrow')) == 'arrow'
+    opened = schemes.open_scheme(registered[parts[1]])
+    # cached under the data version, so an appended store is served fresh
+    key = ('api', opened.scheme.id, opened.cube.version, tuple(parts),
+           tuple(sorted((k, v[-1]) for k, v in query.items() if k != 'format')), arrow)
+    with instrument.stage(f"api {parts[2] if len(parts) == 3 else 'scheme'}"):
+        response = cache.get_or_build(key, lambda: _build(opened, parts, query, arrow))
+    memory.enforce(keep=opened)
+    return response
+
+
+class Handler(BaseHTTPRequestHandler):
+    registry_path = schemes.REGISTRY
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        try:
+            response = respond(url.path, parse_qs(url.query), self.registry_path,
+                               arrow=ARROW_TYPE in self.headers.get('Accept', ''))
+        except ApiError as error:
+            self._send(error.status, _json({'error': str(error)}), JSON_TYPE)
+            return
+        except Exception:
+            log.exception('GET %s failed', self.path)
+            self._send(500, _json({'error': 'internal server error'}), JSON_TYPE)
+            return
+        encoding = 'gzip' if 'gzip' in self.headers.get('Accept-Encoding', '') else None
+        # the compressed body is a different representation with its own tag
+        etag = f'{response.etag[:-1]}-gzip"' if encoding else response.etag
+        if etag in self.headers.get('If-None-Match', ''):
+            self._send(304, b'', None, etag)
+        else:
+            self._send(200, response.gzipped if encoding else response.body, response.content_type, etag, encoding)
+
+    def _send(self, status, body, content_type, etag=None, encoding=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Vary', 'Accept, Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=8600, host='127.0.0.1', registry_path=schemes.REGISTRY, background=False):
+    """Start the API server; in a daemon thread with ``background``, else block.
+
+    Returns
+    -------
+    http.server.ThreadingHTTPServer
+        The server, once it stops or, in the background, once it is listening.
+    """
+    handler = type('Handler', (Handler,), {'registry_path': registry_path})
+    server = ThreadingHTTPServer((host, port), handler)
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True, name='ipa-api').start()
+    else:
+        with server:
+            server.serve_forever()
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=int(os.environ.get('IPA_API_PORT', 8600)))
+    parser.add_argument('--host', default='127.0.0.1', help='interface to listen on')
+    parser.add_argument('--registry', default=schemes.REGISTRY, help='scheme registry (JSON)')
+    args = parser.parse_args()
+    print(f'serving the indicator API on http://{args.host}:{args.port}/schemes')
+    try:
+        serve(args.port, args.host, args.registry)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,230 @@
+"""Map and bar chart builders shared by the dashboard pages.
+
+plotly and altair are imported when the first chart of their kind is built,
+so importing this module (and serving cached figures) does not load them.
+"""
+import functools
+
+import numpy as np
+
+# map view of the scheme
+MAP_CENTER = {"lat": -0.69306, "lon":  37.35908}
+MAP_ZOOM = 10.3
+
+UNITS = {'beneficial fraction':'-', 'crop water deficit': '-',
+         'relative water deficit': '-', 'total seasonal biomass production': 'ton',
+         'seasonal yield': 'ton/ha', 'crop water productivity': 'kg/m<sup>3</sup>'}
+
+
+@functools.lru_cache(maxsize=None)
+def _altair():
+    """altair, imported and configured on first use."""
+    import altair as alt
+
+    alt.themes.enable("dark")
+    # bar charts embed one row per block and year, beyond the 5000 row default of large schemes
+    alt.data_transformers.disable_max_rows()
+    return alt
+
+
+# map layers: the values of a year, their trend over the years, a year's anomaly,
+# or the values of all years as an animation
+MAP_LAYERS = ('value', 'trend', 'anomaly', 'years')
+# milliseconds each year is shown when the animation plays
+FRAME_DURATION = 800
+
+STAT_NAMES = {'std':'Standard deviation', 'min':'Minimum', 'max':'Maximum', 'mean':'Average',
+              'p10':'10th percentile', 'p50':'Median', 'p90':'90th percentile'}
+
+
+def indicator_title(indicator):
+    lst = indicator.split('_')
+    t1 = ' '.join(lst[:-1])
+    t2 = f"{STAT_NAMES[lst[-1]]} of {t1}" 
+    return t1,t2
+
+
+def _wrap_label(ylable):
+    w = ylable.split()
+    if(len(w)%2):
+        w.append ("")
+    return [' '.join((w[2*i], w[2*i+1]))  for i in range(len(w)//2)]
+
+
+# Choropleth map
+def make_Choroplethmapbox(geo, indicator, df, year, unit, level='block',
+                          center=MAP_CENTER, zoom=MAP_ZOOM, layer='value'):
+    """Choropleth of one year of an indicator.
+
+    ``df`` holds the name column of the level (``section_name`` and ``block``
+    for blocks) and the ``indicator`` column; it is not modified. For the
+    ``trend`` layer the column holds slopes per year and ``year`` the period
+    fitted, for the ``anomaly`` layer z-scores; both are drawn on a diverging
+    scale centred on zero.
+    """
+    import plotly.express as px
+
+    ylable, text = indicator_title(indicator)
+    col_name = 'block' if level == 'block' else 'section_name'
+    if layer == 'trend':
+        title, colorbar, label = f"Trend of {text} over {year}", f'{ylable} [{unit}/year]', f'{ylable} trend'
+    elif layer == 'anomaly':
+        title, colorbar, label = f"Anomaly of {text} for year {year}", 'z-score', f'{ylable} z-score'
+    else:
+        title, colorbar, label = f"Map of {text} for year {year}", f'{ylable} [{unit}]', ylable
+    if layer == 'value':
+        color_scale, range_color = "Viridis", (df[indicator].min(), df[indicator].max())
+    else:
+        bound = df[indicator].abs().max() if len(df) else 1.0
+        color_scale, range_color = "RdBu", (-bound, bound)
+    df = df.assign(indicator=label)
+    if level == 'block':
+        custom_data = [df['section_name'], df[indicator], df['block'], df['indicator']]
+    else:
+        custom_data = [df[col_name], df[indicator], df['indicator']]
+    fig = px.choropleth_mapbox(df,  # dataframe to plothangi veri seti
+                               geojson=geo,  # the geolocation
+                               locations=df[col_name],
+                               featureidkey=f"properties.{col_name}",
+                               color=df[indicator],  
+                               color_continuous_scale=color_scale,  #
+                               range_color=range_color,
+                               center=center,
+                               mapbox_style="carto-darkmatter",  # mapbox style
+                               template='plotly_dark',
+                               zoom=zoom,  # zoom level
+                               opacity=0.9,  # opacity
+                               custom_data=custom_data,
+                               width=600, height=400,
+                               )
+    fig.update_layout(title=title)
+    if level != 'block':
+        fig.update_layout(title_x=0.2)  # Title position
+    # colrbar configuration
+    fig.update_layout(
+                      coloraxis_colorbar_title=colorbar,
+                      coloraxis_colorbar_title_side="right",
+                      coloraxis_colorbar_thickness=15,
+                      )
+    # hver template; slopes per year are small
+    digits = 3 if layer == 'trend' else 2
+    hovertemp = '<i style="color:white;">Section:</i><b> %{customdata[0]}</b><br>'
+    if level == 'block':
+        hovertemp += '<i>Block:</i><b> %{customdata[2]}</b><br>'
+        hovertemp += f"%{{customdata[3]}}: %{{customdata[1]:,.{digits}f}}<br>"
+    else:
+        hovertemp += f"%{{customdata[2]}}: %{{customdata[1]:,.{digits}f}}<br>"
+    fig.update_traces(hovertemplate=hovertemp)
+    fig.update_layout(margin={"r":0, "l":0, "b":0})
+    return fig
+
+
+def make_animated_Choroplethmapbox(geo, indicator, history, year, unit, level='block', section_of=None,
+                                   center=MAP_CENTER, zoom=MAP_ZOOM):
+    """Choropleth of all years of an indicator, one animation frame per year.
+
+    ``history`` has one row per name of the level and one column per year.
+    The geometry, names and hover text are in the figure once; every frame
+    holds only the values of its year, on a colour scale shared by all years,
+    and a slider and play button switch years in the browser. ``year`` is the
+    frame shown first; ``section_of`` maps blocks to their sections.
+    """
+    import plotly.graph_objects as go
+
+    ylable, text = indicator_title(indicator)
+    col_name = 'block' if level == 'block' else 'section_name'
+    names = history.index.astype(str).to_numpy()
+    years = [int(y) for y in history.columns]
+    # two more decimals than shown are enough for the colours
+    z = history.to_numpy(dtype=float).round(4)
+    finite = z[np.isfinite(z)]
+    low, high = (finite.min(), finite.max()) if finite.size else (0.0, 1.0)
+    hovertemp = '<i style="color:white;">Section:</i><b> %{customdata[0]}</b><br>'
+    if level == 'block':
+        custom_data = np.column_stack([section_of.reindex(names).to_numpy(dtype=str), names])
+        hovertemp += '<i>Block:</i><b> %{customdata[1]}</b><br>'
+    else:
+        custom_data = names[:, None]
+    hovertemp += f"{ylable}: %{{z:,.2f}}<extra></extra>"
+    first = years.index(year) if year in years else len(years) - 1
+    fig = go.Figure(
+        go.Choroplethmapbox(geojson=geo, locations=names, featureidkey=f"properties.{col_name}",
+                            z=z[:, first], zmin=low, zmax=high, colorscale="Viridis", marker_opacity=0.9,
+                            customdata=custom_data, hovertemplate=hovertemp,
+                            colorbar=dict(title=dict(text=f'{ylable} [{unit}]', side='right'), thickness=15)),
+        frames=[go.Frame(name=str(y), data=[go.Choroplethmapbox(z=z[:, j])], traces=[0])
+                for j, y in enumerate(years)])
+    # choropleths are redrawn, not tweened, between frames
+    play = {'frame': {'duration': FRAME_DURATION, 'redraw': True}, 'transition': {'duration': 0},
+            'fromcurrent': True}
+    jump = {'mode': 'immediate', 'frame': {'duration': 0, 'redraw': True}, 'transition': {'duration': 0}}
+    fig.update_layout(
+        title=f"Map of {text} for years {years[0]}–{years[-1]}" if years else f"Map of {text}",
+        template='plotly_dark', width=600, height=490,
+        mapbox=dict(style="carto-darkmatter", center=center, zoom=zoom),
+        # the slider and the play button below the map
+        margin={"r": 0, "l": 0, "b": 90},
+        updatemenus=[dict(type='buttons', direction='left', x=0, y=0, xanchor='left', yanchor='top',
+                          pad={'t': 40}, showactive=False,
+                          buttons=[dict(label='▶', method='animate', args=[None, play]),
+                                   dict(label='❚❚', method='animate', args=[[None], jump])])],
+        sliders=[dict(active=first, x=0.12, len=0.88, y=0, yanchor='top', pad={'t': 30},
+                      currentvalue={'prefix': 'Year: '},
+                      steps=[dict(label=str(y), method='animate', args=[[str(y)], jump]) for y in years])])
+    if level != 'block':
+        fig.update_layout(title_x=0.2)
+    return fig
+
+
+def show_frame(fig, year):
+    """Start an animated choropleth at the frame of ``year``, in place."""
+    names = [frame.name for frame in fig.frames]
+    if str(year) in names:
+        j = names.index(str(year))
+        fig.data[0].z = fig.frames[j].data[0].z
+        fig.layout.sliders[0].active = j
+    return fig
+
+
+# histogram plot
+def make_alt_chart(df, indicator, level='block'):
+    """Yearly bar chart of an indicator.
+
+    For sections one chart holds all sections; for blocks there is a bar
+    panel per section, all drawn from a single dataset.
+    """
+    alt = _altair()
+    ylable, text = indicator_title(indicator)
+    ylable = _wrap_label(ylable)
+    if level != 'block':
+        title = alt.TitleParams(f'Yearly {text} by section', anchor='middle')
+        return alt.Chart(df, title=title).mark_bar().encode(
+            x=alt.X('section_name:N', axis=None),
+            y=alt.Y(f'{indicator}:Q', title=ylable),
+            color='section_name:N',
+            column='year:N'
+        ).properties(width=80, height=80).configure_legend(
+            orient='bottom'
+        )
+
+    charts = []
+    for section in df['section_name'].unique():
+        title = alt.TitleParams(text = f'{text} per block for years'
+                                       f' {df.year.min()} to {df.year.max()}',
+                                subtitle = f'Section: {section}',
+                                subtitleFontSize = 18, 
+                                subtitleColor = '#FFFF80',
+                                fontSize = 16, fontWeight = 'bold', subtitleFontWeight = 'bold'
+                                )
+        chart = alt.Chart(title=title).mark_bar().encode(
+            x=alt.X('block:N', axis=None),
+            y=alt.Y(f'{indicator}:Q', title=ylable),
+            color=alt.Color('block:N', legend=alt.Legend(orient='bottom', columns=15)),
+            column='year:N'
+        ).transform_filter(
+            alt.datum.section_name == section
+        ).properties(width=100, height=80)
+        charts.append(chart)
+
+    # the data is serialized once at the top level and filtered per section
+    return alt.vconcat(*charts, data=df).resolve_scale(color='independent')
@@ -0,0 +1,372 @@
+"""Pre-aggregated indicator cube.
+
+Block values and their section and whole-scheme aggregates are computed once
+per store version for every year, indicator and statistic, so the dashboard
+panels only look up precomputed frames. When the store changes only the year
+partitions that changed are aggregated again.
+
+Section and scheme statistics are merged exactly from the block moments:
+every block contributes its pixel count ``n``, ``n * mean`` and
+``n * (std ** 2 + mean ** 2)``, so the merged mean and (population) std are
+those of all pixels of the section, and the merged min and max are the
+extremes of the block extremes. Pixel counts come from the ``count``
+statistic written by :mod:`ipa.ingest`, or else from the block polygon areas.
+Where the ingest also wrote quantile sketches, the percentile statistics of
+every level are read from the merged block histograms (:mod:`ipa.sketches`).
+"""
+import os
+import threading
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+from ipa import instrument, sketches as quantile_sketches, store
+
+LEVELS = ('block', 'section', 'scheme')
+# name column of each level in the frames handed to the pages
+NAME_COLUMNS = {'block': 'block', 'section': 'section_name', 'scheme': 'scheme'}
+
+_cubes = {}
+_lock = threading.Lock()
+
+
+def block_moments(long, counts=None):
+    """Pixel count and weighted sums of every block, indicator and year.
+
+    Parameters
+    ----------
+    long : pandas.DataFrame
+        Long-format block statistics.
+    counts : pandas.Series, optional
+        Pixel count by block, used for the rows of ``long`` without a
+        ``count`` statistic; without it those blocks weigh the same.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by (indicator, section_name, block, year) with the columns
+        ``n``, ``sum``, ``sumsq`` and, where present, ``min`` and ``max``.
+    """
+    stats = long.pivot_table(index=['indicator', 'section_name', 'block', 'year'], columns='stat',
+                             values='value', aggfunc='first', observed=True)
+    if counts is not None:
+        blocks = stats.index.get_level_values('block')
+        fallback = pd.Series(counts.reindex(blocks).fillna(counts.mean()).to_numpy(), index=stats.index)
+    else:
+        fallback = pd.Series(1.0, index=stats.index)
+    # rows ingested before counts were written (appends onto older data) have none
+    n = stats[store.COUNT].fillna(fallback) if store.COUNT in stats.columns else fallback
+    mean = stats['mean']
+    # blocks without a value for a year do not count
+    n = n.where(mean.notna(), 0.0)
+    std = stats['std'].fillna(0.0) if 'std' in stats.columns else 0.0
+    moments = pd.DataFrame({'n': n, 'sum': n * mean.fillna(0.0),
+                            'sumsq': n * (std ** 2 + mean.fillna(0.0) ** 2)})
+    for stat in ('min', 'max'):
+        if stat in stats.columns:
+            moments[stat] = stats[stat]
+    return moments
+
+
+def merge_moments(moments, by):
+    """Exact statistics of the groups of blocks with equal ``by`` columns.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by (indicator, stat, *by) with one column per year, for the
+        statistics ``mean``, ``std`` and ``count`` and, if the blocks have
+        them, ``min`` and ``max``.
+    """
+    groups = moments.groupby(['indicator'] + by + ['year'], observed=True)
+    n = groups['n'].sum()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = groups['sum'].sum() / n
+        std = np.sqrt(np.maximum(groups['sumsq'].sum() / n - mean ** 2, 0.0))
+    merged = {'mean': mean, 'std': std, store.COUNT: n}
+    if 'min' in moments.columns:
+        merged['min'] = groups['min'].min()
+    if 'max' in moments.columns:
+        merged['max'] = groups['max'].max()
+    empty = n == 0
+    merged = pd.DataFrame({stat: values.mask(empty) if stat != store.COUNT else values
+                           for stat, values in merged.items()})
+    merged = merged.rename_axis(columns='stat').stack().unstack('year')
+    return merged.reorder_levels(['indicator', 'stat'] + by).sort_index()
+
+
+def aggregate(long, scheme_name='scheme', counts=None, sketches=None):
+    """Block values and exact section/scheme statistics of long-format statistics.
+
+    ``counts`` is the pixel count by block used when the statistics carry
+    none, see :func:`block_moments`. With ``sketches``
+    (:class:`ipa.sketches.QuantileSketches`) the percentile statistics of the
+    years and indicators of ``long`` are added.
+
+    Returns
+    -------
+    dict
+        For every level a DataFrame indexed by (indicator, stat, name) with
+        one column per year.
+    """
+    keys = ['indicator', 'stat']
+    moments = block_moments(long, counts)
+    section = merge_moments(moments, ['section_name'])
+    scheme = merge_moments(moments, [])
+    # only the statistics the blocks have
+    keep = set(long['stat'].unique())
+    wide = {
+        'block': long.pivot_table(index=keys + ['block'], columns='year', values='value', aggfunc='first'),
+        'section': section[section.index.get_level_values('stat').isin(keep)],
+        'scheme': scheme[scheme.index.get_level_values('stat').isin(keep)]
+                      .assign(scheme=scheme_name).set_index('scheme', append=True),
+    }
+    for level, frame in wide.items():
+        frame.columns = [int(y) for y in frame.columns]
+        frame.index.names = keys + [NAME_COLUMNS[level]]
+    if sketches is not None:
+        section_of = long.drop_duplicates('block').set_index('block')['section_name']
+        percentiles = sketches.percentiles(section_of, wide, scheme_name, years=wide['block'].columns)
+        indicators = set(long['indicator'])
+        for level, frame in percentiles.items():
+            # years without sketches are all NaN; left out of the concat, they are filled by it
+            frame = frame[frame.index.get_level_values(0).isin(indicators)].dropna(axis=1, how='all')
+            frame.index.names = keys + [NAME_COLUMNS[level]]
+            wide[level] = pd.concat([wide[level], frame]).reindex(columns=wide[level].columns).sort_index()
+    return wide
+
+
+class IndicatorCube:
+    """Indicator values by (level, year, indicator, stat).
+
+    Parameters
+    ----------
+    long : pandas.DataFrame
+        Long-format statistics as returned by :func:`ipa.store.load_long`.
+    scheme_name : str
+        Name used for the single row of the ``scheme`` level.
+    version : int, optional
+        Version of the data the cube is built from.
+    partitions : dict, optional
+        Version of every year, as in the store manifest. Figures and other
+        artifacts of a single year are keyed by its partition version.
+    counts : pandas.Series, optional
+        Pixel count by block, the weight in section and scheme statistics of
+        the blocks without a ``count`` statistic.
+    sketches : ipa.sketches.QuantileSketches, optional
+        Block histograms the percentile statistics are computed from.
+    """
+
+    def __init__(self, long, scheme_name='scheme', version=None, partitions=None, counts=None, sketches=None):
+        long = long.astype({'section_name': str, 'block': str, 'indicator': str, 'stat': str})
+        self.scheme_name = scheme_name
+        self.version = version
+        self.partitions = dict(partitions or {})
+        self.section_of = long.drop_duplicates('block').set_index('block')['section_name']
+        self.columns = list(dict.fromkeys(long['indicator'] + '_' + long['stat']))
+        self.counts = counts
+        self.sketches = sketches
+        self.wide = aggregate(long, scheme_name, counts, sketches)
+        self.columns += self._percentile_columns(long)
+        self._values = {}
+        self._index(self.years)
+
+    @property
+    def years(self):
+        return sorted(self.wide['block'].columns)
+
+    def _percentile_columns(self, long):
+        if self.sketches is None:
+            return []
+        indicators = set(long['indicator'])
+        return [f'{i}_{s}' for i in self.sketches.indicators if i in indicators
+                for s in quantile_sketches.STATS]
+
+    def stats(self, indicator, year=None):
+        """Statistics of an indicator, the percentiles of its sketches last.
+
+        With ``year`` the percentiles only if the sketches cover that year.
+        """
+        return [s for s in store.STATS + quantile_sketches.STATS if f'{indicator}_{s}' in self.columns
+                and (year is None or s not in quantile_sketches.PERCENTILES
+                     or pd.notna(self.scheme_value(year, indicator, s)))]
+
+    def partition_version(self, year):
+        """Version the year last changed in."""
+        return self.partitions.get(year, self.version)
+
+    def _index(self, years):
+        self._history = {}
+        self._tables = {}
+        self._sparklines = {}
+        for level, wide in self.wide.items():
+            for (indicator, stat), frame in wide.groupby(level=[0, 1], sort=False):
+                self._add(level, indicator, stat, frame.droplevel([0, 1]), years)
+
+    def _add(self, level, indicator, stat, history, years):
+        name = NAME_COLUMNS[level]
+        column = f'{indicator}_{stat}'
+        self._history[level, indicator, stat] = history
+        # one contiguous (names x years) block per indicator, rounded for display
+        block = np.ascontiguousarray(history.to_numpy(dtype=float).round(2))
+        rows = np.empty(len(block), dtype=object)
+        rows[:] = list(block)
+        finite = block[np.isfinite(block)]
+        value_range = (finite.min(), finite.max()) if finite.size else (np.nan, np.nan)
+        self._sparklines[level, indicator, stat] = (history.index.to_numpy(), block, rows, value_range)
+        table = history.rename_axis(columns='year').stack().rename(column).reset_index()
+        table = table[['year', name, column]].sort_values(['year', name], ignore_index=True)
+        if level == 'block':
+            table.insert(1, 'section_name', table['block'].map(self.section_of))
+        self._tables[level, indicator, stat] = table
+        for year in years:
+            values = history[year].dropna().sort_values(ascending=False).rename(column).reset_index()
+            if level == 'block':
+                values.insert(0, 'section_name', values['block'].map(self.section_of))
+            self._values[level, year, indicator, stat] = values
+
+    def updated(self, long, years, removed=(), version=None, partitions=None):
+        """A new cube with the years in ``years`` replaced by the rows of ``long``.
+
+        Only ``long`` (the rows of the changed years) is aggregated; the
+        aggregates of all other years are reused. Year-over-year changes are
+        recomputed only around the changed years.
+        """
+        long = long.astype({'section_name': str, 'block': str, 'indicator': str, 'stat': str})
+        cube = object.__new__(IndicatorCube)
+        cube.scheme_name = self.scheme_name
+        cube.counts = self.counts
+        cube.sketches = self.sketches
+        cube.version = version
+        cube.partitions = dict(partitions or {})
+        sections = long.drop_duplicates('block').set_index('block')['section_name']
+        cube.section_of = sections.combine_first(self.section_of)
+        cube.columns = list(dict.fromkeys(self.columns + list(long['indicator'] + '_' + long['stat'])
+                                          + self._percentile_columns(long)))
+        part = aggregate(long, self.scheme_name, self.counts, self.sketches) if len(long) else {}
+        cube.wide = {}
+        for level, wide in self.wide.items():
+            wide = wide.drop(columns=[y for y in list(years) + list(removed) if y in wide.columns])
+            if level in part:
+                wide = wide.join(part[level], how='outer')
+            cube.wide[level] = wide[sorted(wide.columns)]
+        cube._values = {k: v for k, v in self._values.items() if k[1] not in years and k[1] not in removed}
+        cube._index(years)
+        if 'deltas' in self.__dict__:
+            cube.deltas = self.deltas.updated(cube, set(years) | set(removed))
+        return cube
+
+    def values(self, level, year, indicator, stat):
+        """Values of one year sorted in descending order.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The name column of the level (``section_name`` and ``block`` for
+            blocks) and a ``<indicator>_<stat>`` value column.
+        """
+        return self._values[level, year, indicator, stat].copy(deep=False)
+
+    def table(self, level, indicator, stat):
+        """Values of all years in long layout: ``year``, name column(s) and value column."""
+        return self._tables[level, indicator, stat].copy(deep=False)
+
+    def history(self, level, indicator, stat):
+        """Values of all years with one row per name and one column per year."""
+        return self._history[level, indicator, stat]
+
+    def ranked_history(self, level, year, indicator, stat):
+        """Values of one year in descending order with the history of every row.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The name column of the level, a ``<indicator>_<stat>`` value column
+            and a ``history`` column holding each row's values of all years
+            (read-only views into a shared array), rounded to two decimals.
+        """
+        names, block, rows, _ = self._sparklines[level, indicator, stat]
+        current = block[:, self.years.index(year)]
+        order = np.flatnonzero(~np.isnan(current))
+        order = order[np.argsort(-current[order], kind='stable')]
+        return pd.DataFrame({NAME_COLUMNS[level]: names[order], f'{indicator}_{stat}': current[order],
+                             'history': rows[order]})
+
+    def sparklines(self, level, indicator, stat):
+        """Names, their (names x years) rounded history block and its value range."""
+        names, block, _, value_range = self._sparklines[level, indicator, stat]
+        return names, block, value_range
+
+    def history_range(self, level, indicator, stat=None):
+        """Smallest and largest value of an indicator over all years and names.
+
+        With ``stat`` the range of that statistic, otherwise of all statistics
+        of the indicator.
+        """
+        if stat is not None:
+            return self._sparklines[level, indicator, stat][3]
+        ranges = [v[3] for k, v in self._sparklines.items() if k[0] == level and k[1] == indicator]
+        return np.nanmin([r[0] for r in ranges]), np.nanmax([r[1] for r in ranges])
+
+    @cached_property
+    def deltas(self):
+        """Year-over-year changes of this cube, see :class:`ipa.deltas.DeltaEngine`."""
+        from ipa.deltas import DeltaEngine
+
+        return DeltaEngine(self)
+
+    @cached_property
+    def trends(self):
+        """Trends and anomalies of this cube, see :class:`ipa.trends.TrendEngine`."""
+        from ipa.trends import TrendEngine
+
+        return TrendEngine(self)
+
+    def scheme_value(self, year, indicator, stat):
+        """Whole-scheme aggregate of one year."""
+        return self._history['scheme', indicator, stat].iloc[0][year]
+
+
+def load_cube(store_path=store.STORE_PATH, scheme_name='scheme', blocks_path=None, sketches_path=None):
+    """Indicator cube of a store, shared by all sessions.
+
+    The cube is built once and, when the store version changes, updated with
+    the changed year partitions only. Blocks are weighted by the pixel counts
+    of the store or, without them, by their area in ``blocks_path``. The
+    percentiles come from the sketches in ``sketches_path``, if it exists; new
+    sketches rebuild the cube.
+    """
+    current = store.manifest(store_path)
+    sketches = quantile_sketches.load_sketches(sketches_path)
+    key = os.path.abspath(store_path)
+    cube = _cubes.get(key)
+    if cube is not None and cube.version == current['version'] and cube.sketches is sketches:
+        return cube
+    with _lock:
+        cube = _cubes.get(key)
+        if cube is None or cube.version != current['version'] or cube.sketches is not sketches:
+            partitions = {y: p['version'] for y, p in current['partitions'].items()}
+            if cube is None or cube.sketches is not sketches:
+                with instrument.stage('build_cube'):
+                    counts = None
+                    if blocks_path is not None:
+                        from ipa.geometry import pixel_counts
+
+                        counts = pixel_counts(blocks_path)
+                    cube = IndicatorCube(store.load_long(store_path=store_path, snapshot=current),
+                                         scheme_name, current['version'], partitions, counts, sketches)
+            else:
+                changed = [y for y, v in partitions.items() if cube.partitions.get(y) != v]
+                removed = [y for y in cube.partitions if y not in partitions]
+                with instrument.stage('update_cube'):
+                    long = store.load_long(year=changed, store_path=store_path, snapshot=current)
+                    cube = cube.updated(long, changed, removed, current['version'], partitions)
+            _cubes[key] = cube
+    return cube
+
+
+def evict(store_path=store.STORE_PATH):
+    """Forget the cube of a store."""
+    with _lock:
+        _cubes.pop(os.path.abspath(store_path), None)
@@ -0,0 +1,131 @@
+"""Process-wide cached loaders for the dashboard data files.
+
+Every Streamlit session and both dashboard pages share one parsed copy of each
+file. A file is parsed again only when its modification time or size changes
+and its content hash differs from the cached one, so touching a file without
+changing it does not trigger a re-parse.
+
+The returned objects are shared between sessions and must be treated as
+read-only. DataFrames are handed out with pandas copy-on-write enabled, so
+derived frames never write through to the cached one.
+"""
+import hashlib
+import io
+import json
+import os
+import threading
+
+import pandas as pd
+
+from ipa import instrument
+
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(ROOT_DIR, 'data')
+STATS_CSV = os.path.join(DATA_DIR, 'Mwea_IPA_stat_by_blocks.csv')
+BLOCKS_JSON = os.path.join(DATA_DIR, 'Mwea_blocks.json')
+LOGO_WIDE = os.path.join(DATA_DIR, 'logo_wide.png')
+LOGO_SMALL = os.path.join(DATA_DIR, 'logo_small.png')
+# widest image Streamlit serves as is (its MAXIMUM_CONTENT_WIDTH)
+LOGO_MAX_WIDTH = 1460
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def file_signature(path):
+    """Cheap change marker of a file: modification time and size."""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def cached_parse(path, parser):
+    """Return ``parser(raw_bytes)`` for ``path``, parsed once per process.
+
+    Parameters
+    ----------
+    path : str
+        Local path of the file.
+    parser : callable
+        Function turning the raw file content into the cached object.
+
+    Returns
+    -------
+    object
+        The shared parsed object.
+    """
+    key = (os.path.abspath(path), parser)
+    signature = file_signature(path)
+    entry = _cache.get(key)
+    if entry is not None and entry[0] == signature:
+        return entry[2]
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None or entry[0] != signature:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            digest = hashlib.sha1(raw).hexdigest()
+            if entry is not None and entry[1] == digest:
+                entry = (signature, digest, entry[2])
+            else:
+                with instrument.stage(parser.__name__.lstrip('_')):
+                    entry = (signature, digest, parser(raw))
+            _cache[key] = entry
+    return entry[2]
+
+
+def file_digest(path):
+    """Content hash of ``path``, recomputed only when the file changes."""
+    cached_parse(path, _no_parse)
+    return _cache[(os.path.abspath(path), _no_parse)][1]
+
+
+def _no_parse(raw):
+    return None
+
+
+def _parse_csv(raw):
+    return pd.read_csv(io.BytesIO(raw))
+
+
+def _parse_json(raw):
+    return json.loads(raw)
+
+
+def _parse_logo(raw):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(raw))
+    # Streamlit resizes and re-encodes wider images on every rerun
+    if image.width > LOGO_MAX_WIDTH:
+        image = image.resize((LOGO_MAX_WIDTH, round(image.height * LOGO_MAX_WIDTH / image.width)),
+                             Image.BILINEAR)
+        out = io.BytesIO()
+        image.save(out, format='PNG')
+        return out.getvalue()
+    return raw
+
+
+def load_stats(path=STATS_CSV):
+    """Indicator statistics by block, one column per indicator and statistic."""
+    return cached_parse(path, _parse_csv)
+
+
+def load_blocks(path=BLOCKS_JSON):
+    """Block polygons as a GeoJSON ``FeatureCollection`` dict."""
+    return cached_parse(path, _parse_json)
+
+
+def load_logo(image_name: str) -> bytes:
+    """PNG bytes of a logo that ``st.logo`` can serve without re-encoding on every rerun."""
+    return cached_parse(image_name, _parse_logo)
+
+
+def evict(path):
+    """Forget everything cached for ``path``."""
+    path = os.path.abspath(path)
+    with _lock:
+        for key in [k for k in _cache if k[0] == path]:
+            del _cache[key]
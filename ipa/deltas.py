@@ -0,0 +1,110 @@
+"""Year-over-year changes of the indicator values.
+
+Changes are computed for every name, indicator and statistic of a level in
+one vectorized subtraction over the year columns of the cube, aligned on the
+block or section name rather than on row position. A name missing in either
+year has no change. When a cube is updated with new or changed years, only
+the rankings of the years affected by the change are recomputed.
+"""
+import pandas as pd
+
+from ipa.cube import LEVELS, NAME_COLUMNS
+
+
+class DeltaEngine:
+    """Year-over-year changes and gainers/losers derived from an indicator cube.
+
+    Parameters
+    ----------
+    cube : ipa.cube.IndicatorCube
+        Cube the changes are computed from.
+    lags : tuple of int
+        Year lags whose ranked changes are precomputed for every level.
+    """
+
+    def __init__(self, cube, lags=(1,)):
+        self.cube = cube
+        self._deltas = {}
+        self._ranked = {}
+        self._ranked_lags = set()
+        for lag in lags:
+            for level in LEVELS:
+                self._rank(level, lag)
+
+    def deltas(self, level, lag=1):
+        """Change from ``year - lag`` to ``year``.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Indexed like ``cube.wide[level]`` (indicator, stat, name) with one
+            column per year.
+        """
+        key = (level, lag)
+        if key not in self._deltas:
+            years = self.cube.years
+            wide = self.cube.wide[level].reindex(columns=range(years[0], years[-1] + 1))
+            self._deltas[key] = (wide - wide.shift(lag, axis=1)).reindex(columns=years)
+        return self._deltas[key]
+
+    def between(self, level, from_year, to_year):
+        """Change from ``from_year`` to ``to_year`` of every name, indicator and statistic."""
+        wide = self.cube.wide[level]
+        return (wide[to_year] - wide[from_year]).rename('indicator_difference')
+
+    def updated(self, cube, years):
+        """Engine of an updated cube, re-ranking only the years affected by a change of ``years``."""
+        engine = object.__new__(DeltaEngine)
+        engine.cube = cube
+        engine._deltas = {}
+        engine._ranked = {}
+        engine._ranked_lags = set(self._ranked_lags)
+        lags = {lag for _, lag in self._ranked_lags}
+        affected = {lag: {y + d for y in years for d in (0, lag)} for lag in lags}
+        engine._ranked = {k: v for k, v in self._ranked.items() if k[2] not in affected[k[1]]}
+        for level, lag in self._ranked_lags:
+            engine._rank(level, lag, affected[lag] & set(cube.years))
+        return engine
+
+    def _rank(self, level, lag, years=None):
+        self._ranked_lags.add((level, lag))
+        name = NAME_COLUMNS[level]
+        deltas = self.deltas(level, lag)
+        wide = self.cube.wide[level]
+        if years is not None:
+            deltas = deltas[[y for y in deltas.columns if y in years]]
+            wide = wide[deltas.columns]
+        delta = deltas.stack().rename('indicator_difference')
+        value = wide.stack().rename('value')
+        long = pd.concat([value, delta], axis=1, join='inner').rename_axis(
+            index=['indicator', 'stat', name, 'year']).reset_index()
+        long = long.sort_values(['indicator', 'stat', 'year', 'indicator_difference'],
+                                ascending=[True, True, True, False])
+        for (indicator, stat, year), frame in long.groupby(['indicator', 'stat', 'year'], sort=False):
+            ranked = frame[[name, 'value', 'indicator_difference']].rename(
+                columns={'value': f'{indicator}_{stat}'}).reset_index(drop=True)
+            if level == 'block':
+                ranked.insert(0, 'section_name', ranked['block'].map(self.cube.section_of))
+            self._ranked[level, lag, year, indicator, stat] = ranked
+
+    def ranked(self, level, year, indicator, stat, lag=1):
+        """Values of ``year`` with their change, sorted from largest gain to largest loss.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Name column(s), ``<indicator>_<stat>`` and ``indicator_difference``.
+            Empty if no name has a value in ``year - lag``.
+        """
+        if (level, lag) not in self._ranked_lags:
+            self._rank(level, lag)
+        ranked = self._ranked.get((level, lag, year, indicator, stat))
+        if ranked is None:
+            columns = (['section_name'] if level == 'block' else []) + [NAME_COLUMNS[level]]
+            return pd.DataFrame(columns=columns + [f'{indicator}_{stat}', 'indicator_difference'])
+        return ranked.copy(deep=False)
+
+    def movers(self, level, year, indicator, stat, n=1, lag=1):
+        """The ``n`` largest gainers and the ``n`` largest losers, losers largest loss first."""
+        ranked = self.ranked(level, year, indicator, stat, lag)
+        return ranked.head(n), ranked.iloc[::-1].head(n).reset_index(drop=True)
@@ -0,0 +1,216 @@
+"""Static export of every dashboard view of a scheme.
+
+Renders the map, bar chart, gains/losses and ranked table of every level,
+year, indicator and statistic into a directory that any static file server or
+CDN can serve, with an ``index.html`` offering the same selections as the
+dashboard. Views are rendered by a process pool; the bundle is laid out as::
+
+    index.html
+    manifest.json                          years, indicators, statistics, levels
+    geometry/<level>.json                  polygons, shared by all maps of a level
+    bars/<level>/<indicator>_<stat>.json   Vega-Lite spec of the yearly bar chart
+    histories/<level>/<indicator>_<stat>.json
+                                           names and values of all years (ranked table)
+    views/<level>/<indicator>_<stat>/<year>.json
+                                           choropleth without its geometry, gains/losses
+
+Usage::
+
+    python -m ipa.export OUT_DIR [--scheme mwea] [--workers 4]
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ipa import charts, figures, schemes
+from ipa.cube import NAME_COLUMNS
+
+_opened = None
+
+INDEX_HTML = """<!doctype html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title} Irrigation Performance Indicators</title>
+<script src="https://cdn.plot.ly/plotly-2.35.2.min.js"></script>
+<script src="https://cdn.jsdelivr.net/npm/vega@5"></script>
+<script src="https://cdn.jsdelivr.net/npm/vega-lite@5"></script>
+<script src="https://cdn.jsdelivr.net/npm/vega-embed@6"></script>
+<style>
+body {{ background: #0e1117; color: #fafafa; font-family: sans-serif; margin: 1rem 2rem; }}
+label {{ margin-right: 1rem; }}
+.row {{ display: flex; gap: 2rem; margin-top: 1rem; }}
+.metric {{ background: #1c1b1b; text-align: center; padding: 4px 8px; margin-bottom: 8px; }}
+.up {{ color: #09ab3b; }} .down {{ color: #ff2b2b; }}
+table {{ border-collapse: collapse; }} td, th {{ padding: 2px 8px; text-align: left; }}
+</style>
+</head>
+<body>
+<h2>{title} Irrigation Performance Indicators</h2>
+<div>
+<label>Level <select id="level"></select></label>
+<label>Year <select id="year"></select></label>
+<label>Indicator <select id="indicator"></select></label>
+<label>Statistic <select id="stat"></select></label>
+</div>
+<div class="row">
+<div><div id="map"></div><div id="bars"></div></div>
+<div id="movers" style="min-width: 10rem"><h4>Gains/Losses from previous year</h4></div>
+<div><h4>Indicator ranked</h4><table id="ranked"></table></div>
+</div>
+<script>
+const cache = {{}};
+const get = path => cache[path] || (cache[path] = fetch(path).then(r => r.json()));
+const $ = id => document.getElementById(id);
+
+function fill(select, values, labels) {{
+  select.innerHTML = values.map((v, i) => `<option value="${{v}}">${{labels ? labels[i] : v}}</option>`).join('');
+  select.onchange = render;
+}}
+
+function sparkline(values, lo, hi) {{
+  const points = values.map((v, i) => v === null ? null :
+    `${{i * 100 / Math.max(values.length - 1, 1)}},${{24 - (v - lo) * 24 / ((hi - lo) || 1)}}`).filter(p => p);
+  return `<svg width="100" height="24"><polyline fill="none" stroke="#29b5e8" points="${{points.join(' ')}}"/></svg>`;
+}}
+
+function metric(mover) {{
+  if (!mover) return '<div class="metric">-</div>';
+  const cls = mover.delta >= 0 ? 'up' : 'down';
+  return `<div class="metric">${{mover.label}}<br><b>${{mover.value.toFixed(2)}}</b><br>` +
+         `<span class="${{cls}}">${{mover.delta >= 0 ? '&#9650;' : '&#9660;'}} ${{mover.delta.toFixed(2)}}</span></div>`;
+}}
+
+async function render() {{
+  const level = $('level').value, year = +$('year').value;
+  const key = `${{$('indicator').value}}_${{$('stat').value}}`;
+  const [geometry, view, bars, history] = await Promise.all([
+    get(`geometry/${{level}}.json`), get(`views/${{level}}/${{key}}/${{year}}.json`),
+    get(`bars/${{level}}/${{key}}.json`), get(`histories/${{level}}/${{key}}.json`)]);
+  view.map.data[0].geojson = geometry;
+  Plotly.react('map', view.map.data, view.map.layout);
+  vegaEmbed('#bars', bars, {{actions: false}});
+  $('movers').innerHTML = '<h4>Gains/Losses from previous year</h4>' + metric(view.gain) + metric(view.loss);
+  const column = history.years.indexOf(year);
+  const rows = history.names.map((name, i) => [name, history.values[i]])
+    .filter(row => row[1][column] !== null).sort((a, b) => b[1][column] - a[1][column]);
+  $('ranked').innerHTML = `<tr><th>Name</th><th>&#11088;${{year}}</th><th>values since ${{history.years[0]}}</th></tr>` +
+    rows.map(([name, values]) => `<tr><td>${{name}}</td><td>${{values[column].toFixed(2)}}</td>` +
+                                 `<td>${{sparkline(values, history.min, history.max)}}</td></tr>`).join('');
+}}
+
+get('manifest.json').then(m => {{
+  fill($('level'), m.levels, m.levels.map(l => l[0].toUpperCase() + l.slice(1) + 's'));
+  fill($('year'), m.years.slice().reverse());
+  fill($('indicator'), m.indicators, m.indicators.map(i => i.replaceAll('_', ' ')));
+  fill($('stat'), m.stats, m.stat_labels);
+  render();
+}});
+</script>
+</body>
+</html>
+"""
+
+
+def _json_values(values):
+    """A float array as a JSON-ready list, NaN as ``None``."""
+    return [None if np.isnan(v) else round(float(v), 4) for v in values]
+
+
+def _write(out_dir, path, obj):
+    path = os.path.join(out_dir, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(obj if isinstance(obj, str) else json.dumps(obj, separators=(',', ':')))
+
+
+def _init_worker(registry_path, scheme_id):
+    global _opened
+    _opened = schemes.open_scheme(schemes.get_scheme(scheme_id, registry_path))
+
+
+def _mover(ranked, row, level, column):
+    if not len(ranked):
+        return None
+    label = ranked[NAME_COLUMNS[level]].iloc[row]
+    if level == 'block':
+        label = f"{label} in {ranked['section_name'].iloc[row]}"
+    return {'label': label, 'value': float(ranked[column].iloc[row]),
+            'delta': float(ranked['indicator_difference'].iloc[row])}
+
+
+def _render(task):
+    """Write the bar chart, history and every year's view of one (level, indicator, stat)."""
+    out_dir, level, indicator, stat = task
+    opened, scheme = _opened, _opened.scheme
+    cube = opened.cube
+    column = f'{indicator}_{stat}'
+    _write(out_dir, f'bars/{level}/{column}.json', figures.bar_chart_json(opened, level, indicator, stat))
+
+    names, block, (low, high) = cube.sparklines(level, indicator, stat)
+    _write(out_dir, f'histories/{level}/{column}.json',
+           {'years': cube.years, 'names': [str(n) for n in names],
+            'values': [_json_values(row) for row in block], 'min': float(low), 'max': float(high)})
+
+    geo = opened.geometry(level, zoom=scheme.zoom)
+    for year in cube.years:
+        fig = charts.make_Choroplethmapbox(geo, column, cube.values(level, year, indicator, stat), year,
+                                           charts.UNITS[indicator.replace('_', ' ')], level,
+                                           scheme.center, scheme.zoom)
+        # the page loads the level's geometry once and attaches it to every map
+        fig.data[0].geojson = None
+        ranked = cube.deltas.ranked(level, year, indicator, stat)
+        view = {'map': json.loads(fig.to_json()),
+                'gain': _mover(ranked, 0, level, column), 'loss': _mover(ranked, -1, level, column)}
+        _write(out_dir, f'views/{level}/{column}/{year}.json', view)
+    return len(cube.years)
+
+
+def export(out_dir, scheme_id=None, registry_path=schemes.REGISTRY, workers=None):
+    """Render every view of a scheme to a static bundle in ``out_dir``.
+
+    Returns
+    -------
+    dict
+        The bundle manifest.
+    """
+    scheme = schemes.get_scheme(scheme_id, registry_path)
+    # load the cube before forking so the workers inherit it
+    opened = schemes.open_scheme(scheme)
+    cube = opened.cube
+    indicators = sorted({c.rsplit('_', 1)[0] for c in cube.columns})
+    stats = cube.stats(indicators[0])
+    os.makedirs(out_dir, exist_ok=True)
+
+    for level in figures.FIGURE_LEVELS:
+        _write(out_dir, f'geometry/{level}.json', opened.geometry(level, zoom=scheme.zoom))
+    tasks = [(out_dir, level, indicator, stat)
+             for level in figures.FIGURE_LEVELS for indicator in indicators for stat in stats]
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(registry_path, scheme.id)) as pool:
+        views = sum(pool.map(_render, tasks))
+
+    manifest = {'scheme': {'id': scheme.id, 'name': scheme.name, 'title': scheme.title},
+                'version': cube.version, 'years': cube.years, 'levels': list(figures.FIGURE_LEVELS),
+                'indicators': indicators, 'stats': stats, 'stat_labels': [charts.STAT_NAMES[s] for s in stats],
+                'views': views}
+    _write(out_dir, 'manifest.json', manifest)
+    _write(out_dir, 'index.html', INDEX_HTML.format(title=scheme.name))
+    return manifest
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('out_dir', help='directory the bundle is written to')
+    parser.add_argument('--scheme', help='scheme id; the first registered scheme by default')
+    parser.add_argument('--registry', default=schemes.REGISTRY, help='scheme registry (JSON)')
+    parser.add_argument('--workers', type=int, help='number of worker processes')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    built = export(args.out_dir, args.scheme, args.registry, args.workers)
+    print(f"exported {built['views']} views of {built['scheme']['name']} to {args.out_dir} "
+          f"in {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,232 @@
+"""Cache of serialized map figures and bar chart specs.
+
+Figures are keyed by the selectors they depend on and the version of the data
+they were built from (the year partition version for maps), and kept as JSON in a bounded LRU cache shared by all
+sessions. A background thread started with :func:`warm_up` builds every
+selector combination of a scheme once per server process so that the pages
+only look figures up.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from ipa import charts, instrument
+from ipa.cube import LEVELS
+
+# map and bar chart levels the pages show
+FIGURE_LEVELS = tuple(level for level in LEVELS if level != 'scheme')
+
+
+class FigureCache:
+    """Thread-safe LRU cache of serialized figures.
+
+    Parameters
+    ----------
+    max_entries : int
+        Number of figures kept; the least recently used one is evicted first.
+    """
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_build(self, key, build):
+        """Cached value of ``key``, calling ``build()`` on a miss.
+
+        Concurrent misses of one key build it once; the other callers wait
+        for that build and, if it fails, retry it themselves.
+        """
+        while True:
+            with self._lock:
+                value = self._entries.get(key)
+                if value is not None:
+                    self._entries.move_to_end(key)
+                    return value
+                building = self._building.get(key)
+                if building is None:
+                    building = self._building[key] = threading.Event()
+                    break
+            building.wait()
+        try:
+            value = build()
+            self.put(key, value)
+        finally:
+            with self._lock:
+                del self._building[key]
+            building.set()
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def discard(self, scheme_id):
+        """Drop the figures of a scheme."""
+        with self._lock:
+            for key in [k for k in self._entries if k[1] == scheme_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = FigureCache(int(os.environ.get('IPA_FIGURE_CACHE_SIZE', 512)))
+
+_warm_up_threads = {}
+_warm_up_lock = threading.Lock()
+
+
+def _layer_values(opened, level, year, indicator, stat, layer):
+    """Values a map layer is drawn from and the year or period of its title."""
+    cube = opened.cube
+    if layer == 'trend':
+        return cube.trends.trend(level, indicator, stat), f'{cube.years[0]}–{cube.years[-1]}'
+    if layer == 'anomaly':
+        return cube.trends.anomaly(level, year, indicator, stat), year
+    return cube.values(level, year, indicator, stat), year
+
+
+def _map_geometry(opened, level):
+    # all polygons, simplified for the initial zoom, so panning and zooming out show every block
+    return opened.geometry(level, zoom=opened.scheme.zoom)
+
+
+def _map_json(opened, level, year, indicator, stat, layer='value'):
+    scheme = opened.scheme
+    geo = _map_geometry(opened, level)
+    if layer == 'years':
+        cube = opened.cube
+        with instrument.stage('make_animated_Choroplethmapbox'):
+            fig = charts.make_animated_Choroplethmapbox(geo, f'{indicator}_{stat}',
+                                                        cube.history(level, indicator, stat), cube.years[-1],
+                                                        charts.UNITS[indicator.replace('_', ' ')], level,
+                                                        cube.section_of, scheme.center, scheme.zoom)
+        with instrument.stage('serialize map'):
+            return fig.to_json()
+    df, period = _layer_values(opened, level, year, indicator, stat, layer)
+    with instrument.stage('make_Choroplethmapbox'):
+        fig = charts.make_Choroplethmapbox(geo, f'{indicator}_{stat}', df, period,
+                                           charts.UNITS[indicator.replace('_', ' ')], level,
+                                           scheme.center, scheme.zoom, layer)
+    with instrument.stage('serialize map'):
+        return fig.to_json()
+
+
+def _bar_chart_json(opened, level, indicator, stat):
+    with instrument.stage('make_alt_chart'):
+        chart = charts.make_alt_chart(opened.cube.table(level, indicator, stat), f'{indicator}_{stat}', level)
+    with instrument.stage('serialize bar chart'):
+        return chart.to_json()
+
+
+def map_json(opened, level, year, indicator, stat, layer='value'):
+    """Serialized choropleth of one year of an indicator of an opened scheme.
+
+    ``layer`` is one of :data:`ipa.charts.MAP_LAYERS`. The ``years`` layer is
+    one animated figure of all years, shared by every ``year``.
+    """
+    if layer == 'value':
+        # a map depends on one year only, so it survives appends of other years
+        key = ('map', opened.scheme.id, opened.cube.partition_version(year), level, year, indicator, stat)
+    else:
+        # trends, anomalies and animations depend on every year; only an anomaly map on one in particular
+        key = (layer, opened.scheme.id, opened.cube.version, level, year if layer == 'anomaly' else None,
+               indicator, stat)
+    return cache.get_or_build(key, lambda: _map_json(opened, level, year, indicator, stat, layer))
+
+
+def bar_chart_json(opened, level, indicator, stat):
+    """Serialized Vega-Lite spec of the yearly bar chart of an indicator of an opened scheme."""
+    key = ('bar', opened.scheme.id, opened.cube.version, level, indicator, stat)
+    return cache.get_or_build(key, lambda: _bar_chart_json(opened, level, indicator, stat))
+
+
+def map_from_json(fig_json, year, layer='value'):
+    """Choropleth of a serialized map (see :func:`map_json`) showing ``year``, for ``st.plotly_chart``.
+
+    Sessions keep the shared JSON and deserialize it only to render it, so
+    they do not each hold a figure with the whole geometry.
+    """
+    import plotly.io as pio
+
+    with instrument.stage('deserialize map'):
+        fig = pio.from_json(fig_json, skip_invalid=True)
+    if layer == 'years':
+        charts.show_frame(fig, year)
+    return fig
+
+
+def map_figure(opened, level, year, indicator, stat, layer='value'):
+    """Choropleth of one year of an indicator, for ``st.plotly_chart``."""
+    return map_from_json(map_json(opened, level, year, indicator, stat, layer), year, layer)
+
+
+def bar_chart_spec(opened, level, indicator, stat):
+    """Vega-Lite spec of the yearly bar chart of an indicator, for ``st.vega_lite_chart``."""
+    spec_json = bar_chart_json(opened, level, indicator, stat)
+    with instrument.stage('deserialize bar chart'):
+        return json.loads(spec_json)
+
+
+def _warm_up_figures(opened):
+    cube = opened.cube
+    indicators = sorted({c.rsplit('_', 1)[0] for c in cube.columns})
+    for level in FIGURE_LEVELS:
+        for indicator in indicators:
+            for stat in cube.stats(indicator):
+                yield bar_chart_json, (opened, level, indicator, stat)
+    # latest year first, it is the default selection
+    for year in reversed(cube.years):
+        for level in FIGURE_LEVELS:
+            for indicator in indicators:
+                for stat in cube.stats(indicator, year):
+                    yield map_json, (opened, level, year, indicator, stat)
+
+
+def _warm_up(opened):
+    for build, args in _warm_up_figures(opened):
+        # only into free room: the warm-up never evicts a figure, its own or one a session asked for
+        if opened.released or len(cache) >= cache.max_entries:
+            return
+        build(*args)
+
+
+def warm_up(opened):
+    """Start building the figures of an opened scheme in a background thread, once per scheme.
+
+    The bar charts come first, then the maps from the latest year back. The
+    warm-up stops once the figure cache (``IPA_FIGURE_CACHE_SIZE``) is full,
+    so a scheme with more figures than the cache holds is warmed only up to
+    that bounded prefix; the rest is built on demand.
+    """
+    with _warm_up_lock:
+        thread = _warm_up_threads.get(opened.scheme.id)
+        if (thread is None or thread.opened is not opened) and os.environ.get('IPA_FIGURE_WARM_UP', '1') != '0':
+            thread = threading.Thread(target=_warm_up, args=(opened,), daemon=True,
+                                      name=f'ipa-figure-warm-up-{opened.scheme.id}')
+            thread.opened = opened
+            _warm_up_threads[opened.scheme.id] = thread
+            thread.start()
+    return thread
@@ -0,0 +1,290 @@
+"""Section geometry derived from the block polygons.
+
+Sections are dissolved from their blocks once and persisted next to the block
+file (``<blocks>.sections.json``) together with the content hash of the block
+file they were built from. The persisted file is rebuilt only when the block
+file changes. The pixel counts of the blocks, their weights when the
+statistics carry none, are persisted the same way (``<blocks>.pixels.json``),
+so building a cube reads them without touching the geometry.
+
+For the map, block and section geometry is also prepared at a few zoom levels:
+simplified with a tolerance of about half a screen pixel at that zoom (shared
+edges between neighbouring polygons are simplified once, so no gaps or
+overlaps appear) and with coordinates rounded to the precision the zoom can
+show.
+"""
+import json
+import math
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from ipa import data, instrument
+
+# dissolving in worker processes only pays off for larger schemes, and only off the server
+PARALLEL_MIN_SECTIONS = 32
+# zoom levels the map geometry is prepared for
+ZOOM_LEVELS = (8, 10, 12, 14)
+# side of an indicator raster pixel in metres (WaPOR level 3)
+PIXEL_SIZE = 20.0
+# mean earth radius in metres
+EARTH_RADIUS = 6371008.8
+
+_sections = {}
+_pixel_counts = {}
+_simplified = {}
+_lock = threading.Lock()
+
+
+def sections_path(blocks_path):
+    """Path of the persisted section geometry for a block file."""
+    return f'{os.path.splitext(blocks_path)[0]}.sections.json'
+
+
+def pixel_counts_path(blocks_path):
+    """Path of the persisted pixel counts for a block file."""
+    return f'{os.path.splitext(blocks_path)[0]}.pixels.json'
+
+
+def group_by_section(geo):
+    """Block geometries grouped by ``section_name`` in a single pass."""
+    groups = {}
+    for feat in geo['features']:
+        groups.setdefault(feat['properties']['section_name'], []).append(feat['geometry'])
+    return groups
+
+
+def _dissolve(item):
+    from shapely.geometry import mapping, shape
+    from shapely.ops import unary_union
+
+    name, geometries = item
+    merged = unary_union([shape(g) for g in geometries])
+    return name, mapping(merged)
+
+
+def build_section_geometry(geo, processes=None):
+    """Dissolve the block polygons of every section.
+
+    Parameters
+    ----------
+    geo : dict
+        Block polygons as a GeoJSON ``FeatureCollection``.
+    processes : int, optional
+        Number of worker processes. By default sections are dissolved in
+        parallel only for schemes with many sections.
+
+    Returns
+    -------
+    dict
+        Section polygons as a GeoJSON ``FeatureCollection`` with a
+        ``section_name`` property on every feature.
+    """
+    groups = sorted(group_by_section(geo).items())
+    if processes is None:
+        processes = os.cpu_count() if len(groups) >= PARALLEL_MIN_SECTIONS else 1
+    if processes > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            merged = list(pool.map(_dissolve, groups, chunksize=8))
+    else:
+        merged = [_dissolve(item) for item in groups]
+
+    features = [dict(type='Feature', id=i, properties=dict(section_name=name),
+                     geometry=dict(type=geometry['type'], coordinates=geometry['coordinates']))
+                for i, (name, geometry) in enumerate(merged)]
+    return dict(type='FeatureCollection', crs=geo.get('crs'), features=features)
+
+
+def _read_persisted(path, source_hash):
+    try:
+        with open(path) as f:
+            sections = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return sections if sections.get('source_hash') == source_hash else None
+
+
+def _write_persisted(path, sections):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(sections, f)
+        os.replace(tmp, path)
+    except OSError:
+        # read-only deployments keep the in-memory copy only
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_sections(blocks_path=data.BLOCKS_JSON, processes=1):
+    """Section polygons for a block file, built at most once per block file version.
+
+    The result is shared by all sessions and must be treated as read-only.
+    A cold build dissolves the sections in this process: forking a threaded
+    server is unsafe, and spawned workers would re-import the page. Data
+    preparation (the ingest) passes ``processes=None`` to dissolve large
+    schemes in parallel, see :func:`build_section_geometry`.
+    """
+    source_hash = data.file_digest(blocks_path)
+    key = (os.path.abspath(blocks_path), source_hash)
+    sections = _sections.get(key)
+    if sections is not None:
+        return sections
+    with _lock:
+        sections = _sections.get(key)
+        if sections is None:
+            path = sections_path(blocks_path)
+            sections = _read_persisted(path, source_hash)
+            if sections is None:
+                with instrument.stage('build_section_geometry'):
+                    sections = build_section_geometry(data.load_blocks(blocks_path), processes)
+                sections['source_hash'] = source_hash
+                _write_persisted(path, sections)
+            for old in [k for k in _sections if k[0] == key[0]]:
+                del _sections[old]
+            _sections[key] = sections
+    return sections
+
+
+def evict(blocks_path):
+    """Forget the section and simplified geometry and the pixel counts of a block file."""
+    path = os.path.abspath(blocks_path)
+    with _lock:
+        for cache in (_sections, _pixel_counts, _simplified):
+            for key in [k for k in cache if k[0] == path]:
+                del cache[key]
+
+
+def _measure_pixel_counts(geo, pixel_size):
+    from shapely.geometry import shape
+
+    metres_per_degree = EARTH_RADIUS * math.pi / 180
+    counts = {}
+    for feat in geo['features']:
+        polygon = shape(feat['geometry'])
+        area = polygon.area * metres_per_degree ** 2 * math.cos(math.radians(polygon.centroid.y))
+        counts[feat['properties']['block']] = round(area / pixel_size ** 2)
+    return counts
+
+
+def pixel_counts(blocks_path=data.BLOCKS_JSON, pixel_size=PIXEL_SIZE):
+    """Approximate number of raster pixels in every block, from its polygon area.
+
+    The weights of blocks whose statistics carry no pixel counts. Areas are
+    measured on a local equirectangular projection at each polygon's
+    latitude, which is accurate to well under a percent for a block. They are
+    measured at most once per block file version and persisted next to it.
+
+    Returns
+    -------
+    pandas.Series
+        Pixel count by block name.
+    """
+    import pandas as pd
+
+    source_hash = data.file_digest(blocks_path)
+    key = (os.path.abspath(blocks_path), source_hash, pixel_size)
+    counts = _pixel_counts.get(key)
+    if counts is not None:
+        return counts
+    with _lock:
+        counts = _pixel_counts.get(key)
+        if counts is None:
+            path = pixel_counts_path(blocks_path)
+            persisted = _read_persisted(path, source_hash)
+            if persisted is None or persisted.get('pixel_size') != pixel_size:
+                with instrument.stage('pixel_counts'):
+                    persisted = dict(source_hash=source_hash, pixel_size=pixel_size,
+                                     counts=_measure_pixel_counts(data.load_blocks(blocks_path), pixel_size))
+                _write_persisted(path, persisted)
+            counts = pd.Series(persisted['counts'], dtype=float).rename_axis('block')
+            for old in [k for k in _pixel_counts if k[0] == key[0]]:
+                del _pixel_counts[old]
+            _pixel_counts[key] = counts
+    return counts
+
+
+def degrees_per_pixel(zoom):
+    """Longitude degrees covered by one screen pixel of a web-mercator map."""
+    return 360 / (256 * 2 ** zoom)
+
+
+def prepared_zoom(zoom):
+    """The prepared zoom level with enough detail for a map at ``zoom``."""
+    return next((z for z in ZOOM_LEVELS if z >= zoom), ZOOM_LEVELS[-1])
+
+
+def _round_coords(coords, ndigits):
+    if isinstance(coords[0], (int, float)):
+        return [round(c, ndigits) for c in coords]
+    return [_round_coords(c, ndigits) for c in coords]
+
+
+def simplify_geojson(geo, zoom):
+    """Simplified and quantized copy of a GeoJSON ``FeatureCollection``.
+
+    Parameters
+    ----------
+    geo : dict
+        Polygons as a GeoJSON ``FeatureCollection``.
+    zoom : float
+        Map zoom level the geometry is prepared for.
+
+    Returns
+    -------
+    dict
+        A new ``FeatureCollection`` with the same feature ids and properties.
+    """
+    import shapely
+    from shapely.geometry import mapping, shape
+
+    pixel = degrees_per_pixel(zoom)
+    ndigits = math.ceil(-math.log10(pixel)) + 1
+    geometries = [shape(f['geometry']) for f in geo['features']]
+    if hasattr(shapely, 'coverage_simplify'):
+        simplified = shapely.coverage_simplify(geometries, pixel / 2)
+    else:
+        simplified = [g.simplify(pixel / 2, preserve_topology=True) for g in geometries]
+
+    features = []
+    for feat, original, geometry in zip(geo['features'], geometries, simplified):
+        if geometry.is_empty:
+            geometry = original
+        geometry = mapping(geometry)
+        features.append(dict(feat, geometry=dict(type=geometry['type'],
+                                                 coordinates=_round_coords(geometry['coordinates'], ndigits))))
+    return dict(type='FeatureCollection', crs=geo.get('crs'), features=features)
+
+
+def load_geometry(level='block', zoom=None, blocks_path=data.BLOCKS_JSON):
+    """Block or section polygons for the map, prepared for ``zoom``.
+
+    Parameters
+    ----------
+    level : str
+        ``'block'`` or ``'section'``.
+    zoom : float, optional
+        Zoom of the map. Full precision geometry is returned if not given.
+    blocks_path : str
+        Local path of the block GeoJSON.
+
+    Returns
+    -------
+    dict
+        Shared, read-only GeoJSON ``FeatureCollection``.
+    """
+    base = data.load_blocks(blocks_path) if level == 'block' else load_sections(blocks_path)
+    if zoom is None:
+        return base
+    zoom = prepared_zoom(zoom)
+    path = os.path.abspath(blocks_path)
+    key = (path, data.file_digest(blocks_path), level, zoom)
+    geometry = _simplified.get(key)
+    if geometry is None:
+        with instrument.stage('simplify_geojson'):
+            geometry = simplify_geojson(base, zoom)
+        with _lock:
+            for old in [k for k in _simplified if k[0] == path and k[1] != key[1]]:
+                del _simplified[old]
+            _simplified[key] = geometry
+    return geometry
@@ -0,0 +1,363 @@
+"""Offline ingest of WaPOR indicator rasters into block statistics.
+
+Reads one GeoTIFF per indicator and year, named ``<indicator>_<year>.tif``
+(for example ``seasonal_yield_2023.tif``), and computes the mean, minimum,
+maximum and standard deviation of the valid pixels of every block in the
+dashboard's wide CSV layout, and a fixed-bin histogram of them (a quantile
+sketch, see :mod:`ipa.sketches`) that is written next to the CSV.
+
+The block polygons are rasterized once per raster grid into a label array.
+Rasters are read in row bands (windowed I/O) by a process pool, and the
+per-band sufficient statistics (pixel count, sum, sum of squares, min, max)
+and histograms are merged per raster, so any number of years, indicators and
+blocks is processed in parallel without holding a whole raster in memory.
+
+Usage::
+
+    python -m ipa.ingest RASTER_DIR --out data/Mwea_IPA_stat_by_blocks.csv
+
+With ``--append`` the statistics of the ingested years (or blocks) are merged
+into the existing CSV and store instead, rewriting only those years.
+
+Requires ``rasterio``.
+"""
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from ipa import data, geometry
+from ipa.sketches import BINS, QuantileSketches, bin_edges, load_sketches, sketches_path
+from ipa.store import COUNT, STATS
+
+# indicator column order of the dashboard CSV
+INDICATORS = ('beneficial_fraction', 'crop_water_deficit', 'relative_water_deficit',
+              'total_seasonal_biomass_production', 'seasonal_yield', 'crop_water_productivity')
+BAND_ROWS = 1024
+# decimation of the read that estimates the value range of a raster
+RANGE_DECIMATION = 16
+
+_raster_re = re.compile(r'^(?P<indicator>[a-z_]+)_(?P<year>\d{4})\.tiff?$')
+_labels = {}
+
+
+def _rasterio():
+    try:
+        import rasterio
+    except ImportError as e:
+        raise ImportError('rasterio is required to ingest rasters: pip install rasterio') from e
+    return rasterio
+
+
+def _valid(values, labels, nodata):
+    valid = (labels > 0) & np.isfinite(values)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= values != nodata
+    return valid
+
+
+class ZonalStatistics:
+    """Mergeable per-zone pixel statistics.
+
+    Zones are numbered ``1..n_zones``; label ``0`` marks pixels outside every
+    zone.
+    """
+
+    def __init__(self, n_zones):
+        self.count = np.zeros(n_zones + 1, np.int64)
+        self.sum = np.zeros(n_zones + 1)
+        self.sumsq = np.zeros(n_zones + 1)
+        self.min = np.full(n_zones + 1, np.inf)
+        self.max = np.full(n_zones + 1, -np.inf)
+
+    def update(self, values, labels, nodata=None):
+        """Add the pixels of a window; ``labels`` has the shape of ``values``."""
+        valid = _valid(values, labels, nodata)
+        labels = labels[valid]
+        values = values[valid].astype(np.float64)
+        n = len(self.count)
+        self.count += np.bincount(labels, minlength=n)
+        self.sum += np.bincount(labels, weights=values, minlength=n)
+        self.sumsq += np.bincount(labels, weights=values * values, minlength=n)
+        np.minimum.at(self.min, labels, values)
+        np.maximum.at(self.max, labels, values)
+        return self
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        return self
+
+    def result(self):
+        """Mean, min, max, (population) std and pixel count of zones ``1..n_zones``; NaN for empty zones."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            count = self.count[1:]
+            mean = self.sum[1:] / count
+            var = np.maximum(self.sumsq[1:] / count - mean * mean, 0)
+            empty = count == 0
+            return dict(mean=mean, min=np.where(empty, np.nan, self.min[1:]),
+                        max=np.where(empty, np.nan, self.max[1:]), std=np.sqrt(var), count=count)
+
+
+class ZonalHistogram:
+    """Mergeable per-zone histograms on fixed bin edges.
+
+    Values outside the edges are counted in the first or last bin.
+    """
+
+    def __init__(self, n_zones, edges):
+        self.edges = edges
+        self.counts = np.zeros((n_zones + 1, len(edges) - 1), np.int64)
+
+    def update(self, values, labels, nodata=None):
+        """Add the pixels of a window; ``labels`` has the shape of ``values``."""
+        valid = _valid(values, labels, nodata)
+        n_bins = self.counts.shape[1]
+        bins = np.clip(np.searchsorted(self.edges, values[valid], side='right') - 1, 0, n_bins - 1)
+        self.counts += np.bincount(labels[valid] * n_bins + bins,
+                                   minlength=self.counts.size).reshape(self.counts.shape)
+        return self
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    def result(self):
+        """Histograms of zones ``1..n_zones``."""
+        return self.counts[1:]
+
+
+def find_rasters(raster_dir, years=None):
+    """Rasters of a directory as ``{(indicator, year): path}``."""
+    found = {}
+    for name in sorted(os.listdir(raster_dir)):
+        match = _raster_re.match(name)
+        if match and (years is None or int(match['year']) in years):
+            found[match['indicator'], int(match['year'])] = os.path.join(raster_dir, name)
+    return found
+
+
+def _grid_key(src):
+    return (src.crs.to_string() if src.crs else None, tuple(src.transform), src.width, src.height)
+
+
+def block_labels(geo, src):
+    """Rasterize the block polygons on the grid of an open raster.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``int32`` array of the raster's shape holding ``feature index + 1``
+        for pixels whose centre lies in a block and ``0`` elsewhere.
+    """
+    rasterio = _rasterio()
+    from rasterio.features import rasterize
+    from rasterio.warp import transform_geom
+
+    shapes = []
+    for i, feat in enumerate(geo['features']):
+        geometry = feat['geometry']
+        if src.crs and not src.crs.is_geographic:
+            geometry = transform_geom('EPSG:4326', src.crs, geometry)
+        shapes.append((geometry, i + 1))
+    return rasterize(shapes, out_shape=(src.height, src.width), transform=src.transform,
+                     fill=0, dtype=rasterio.int32)
+
+
+def _init_worker(labels):
+    _labels.update(labels)
+
+
+def value_range(src):
+    """Approximate minimum and maximum of an open raster from a decimated read."""
+    shape = (max(src.height // RANGE_DECIMATION, 1), max(src.width // RANGE_DECIMATION, 1))
+    values = src.read(1, out_shape=shape)
+    valid = np.isfinite(values)
+    if src.nodata is not None and not np.isnan(src.nodata):
+        valid &= values != src.nodata
+    values = values[valid]
+    return (float(values.min()), float(values.max())) if values.size else (0.0, 1.0)
+
+
+def _band_statistics(task):
+    path, row_start, row_stop, n_zones, blocks_path, edges = task
+    rasterio = _rasterio()
+    from rasterio.windows import Window
+
+    with rasterio.open(path) as src:
+        key = _grid_key(src)
+        if key not in _labels:
+            _labels[key] = block_labels(data.load_blocks(blocks_path), src)
+        labels = _labels[key]
+        stats = ZonalStatistics(n_zones)
+        histogram = ZonalHistogram(n_zones, edges)
+        # read whole rows of internal tiles/strips at a time
+        step = src.block_shapes[0][0]
+        for row in range(row_start, row_stop, step):
+            stop = min(row + step, row_stop)
+            window = Window(0, row, src.width, stop - row)
+            values = src.read(1, window=window, masked=False)
+            stats.update(values, labels[row:stop], src.nodata)
+            histogram.update(values, labels[row:stop], src.nodata)
+    return stats, histogram
+
+
+def ingest(raster_dir, blocks_path=data.BLOCKS_JSON, years=None, workers=None, edges=None,
+           return_sketches=False):
+    """Block statistics of every raster in ``raster_dir``.
+
+    Parameters
+    ----------
+    raster_dir : str
+        Directory holding ``<indicator>_<year>.tif`` rasters.
+    blocks_path : str
+        Block polygons (GeoJSON) with ``block`` and ``section_name`` properties.
+    years : iterable of int, optional
+        Only ingest these years.
+    workers : int, optional
+        Size of the process pool; one process per CPU by default.
+    edges : dict, optional
+        Histogram bin edges by (indicator, year), to match existing sketches;
+        the approximate value range of the raster otherwise.
+    return_sketches : bool
+        Also return the histograms of every block.
+
+    Returns
+    -------
+    pandas.DataFrame or (pandas.DataFrame, ipa.sketches.QuantileSketches)
+        Wide statistics with the columns of the dashboard CSV and, with
+        ``return_sketches``, their quantile sketches.
+    """
+    rasterio = _rasterio()
+    rasters = find_rasters(raster_dir, set(years) if years is not None else None)
+    if not rasters:
+        raise FileNotFoundError(f'no <indicator>_<year>.tif rasters in {raster_dir}')
+    geo = data.load_blocks(blocks_path)
+    n_zones = len(geo['features'])
+
+    # one set of bin edges per indicator and year, so that the sketches of all blocks of a year merge
+    edges = dict(edges or {})
+    for key, path in rasters.items():
+        if key not in edges:
+            with rasterio.open(path) as src:
+                edges[key] = bin_edges(*value_range(src))
+
+    # rasterize once per grid in the parent; workers inherit or receive the labels
+    labels, tasks = {}, []
+    for key, path in rasters.items():
+        with rasterio.open(path) as src:
+            grid = _grid_key(src)
+            if grid not in labels:
+                labels[grid] = block_labels(geo, src)
+            for row in range(0, src.height, BAND_ROWS):
+                tasks.append((key, (path, row, min(row + BAND_ROWS, src.height), n_zones, blocks_path,
+                                    edges[key])))
+
+    merged, histograms = {}, {}
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(labels,)) as pool:
+        for (key, _), (stats, histogram) in zip(tasks, pool.map(_band_statistics, [t for _, t in tasks],
+                                                                chunksize=4)):
+            merged[key] = merged[key].merge(stats) if key in merged else stats
+            histograms[key] = histograms[key].merge(histogram) if key in histograms else histogram
+
+    indicators = INDICATORS + tuple(sorted({i for i, _ in merged} - set(INDICATORS)))
+    props = pd.DataFrame([f['properties'] for f in geo['features']])[['section_name', 'block']]
+    frames = []
+    for year in sorted({y for _, y in merged}):
+        frame = props.copy()
+        frame.insert(0, 'year', year)
+        for indicator in indicators:
+            if (indicator, year) in merged:
+                for stat, values in merged[indicator, year].result().items():
+                    frame[f'{indicator}_{stat}'] = values
+        frames.append(frame)
+    wide = pd.concat(frames, ignore_index=True)
+    columns = [f'{i}_{s}' for s in STATS + (COUNT,) for i in indicators]
+    wide = wide[['year', 'section_name', 'block'] + [c for c in columns if c in wide.columns]]
+    if not return_sketches:
+        return wide
+
+    years = sorted({y for _, y in histograms})
+    indicators = [i for i in indicators if any((i, y) in histograms for y in years)]
+    counts = np.zeros((n_zones, len(years), len(indicators), BINS), np.int64)
+    # a year without a raster of an indicator has no counts to read its edges for
+    sketch_edges = np.tile(bin_edges(0.0, 1.0), (len(years), len(indicators), 1))
+    for (indicator, year), histogram in histograms.items():
+        counts[:, years.index(year), indicators.index(indicator)] = histogram.result()
+        sketch_edges[years.index(year), indicators.index(indicator)] = histogram.edges
+    sketches = QuantileSketches(props['block'].astype(str), years, indicators, sketch_edges, counts)
+    return wide, sketches
+
+
+def write_synthetic_rasters(out_dir, blocks_path=data.BLOCKS_JSON, years=(2018,), indicators=INDICATORS,
+                            pixel_size=0.0002, seed=0):
+    """Write random ``<indicator>_<year>.tif`` rasters covering the blocks, for tests and benchmarks.
+
+    Returns
+    -------
+    list of str
+        Paths of the written rasters.
+    """
+    rasterio = _rasterio()
+    from rasterio.transform import from_origin
+    from shapely.geometry import shape
+    from shapely.ops import unary_union
+
+    geo = data.load_blocks(blocks_path)
+    west, south, east, north = unary_union([shape(f['geometry']) for f in geo['features']]).bounds
+    width = int(np.ceil((east - west) / pixel_size))
+    height = int(np.ceil((north - south) / pixel_size))
+    profile = dict(driver='GTiff', width=width, height=height, count=1, dtype='float32',
+                   crs='EPSG:4326', transform=from_origin(west, north, pixel_size, pixel_size),
+                   nodata=-9999.0, tiled=True, blockxsize=256, blockysize=256)
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for year in years:
+        for indicator in indicators:
+            values = rng.random((height, width), dtype=np.float32)
+            values[rng.random((height, width)) < 0.01] = profile['nodata']
+            path = os.path.join(out_dir, f'{indicator}_{year}.tif')
+            with rasterio.open(path, 'w', **profile) as dst:
+                dst.write(values, 1)
+            paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('raster_dir', help='directory of <indicator>_<year>.tif rasters')
+    parser.add_argument('--blocks', default=data.BLOCKS_JSON, help='block polygons (GeoJSON)')
+    parser.add_argument('--out', default=data.STATS_CSV, help='output statistics CSV')
+    parser.add_argument('--years', type=int, nargs='*', help='only ingest these years')
+    parser.add_argument('--workers', type=int, help='number of worker processes')
+    parser.add_argument('--append', action='store_true',
+                        help='merge the ingested years/blocks into the existing CSV and store')
+    args = parser.parse_args()
+    # blocks appended to an existing year keep its bin edges; new years get their own
+    existing = load_sketches(sketches_path(args.out)) if args.append else None
+    edges = None
+    if existing is not None:
+        edges = {(indicator, year): existing.edges[j, k] for j, year in enumerate(existing.years)
+                 for k, indicator in enumerate(existing.indicators)}
+    stats, sketches = ingest(args.raster_dir, args.blocks, args.years, args.workers, edges, return_sketches=True)
+    if existing is not None:
+        sketches = existing.merged(sketches)
+    sketches.save(sketches_path(args.out))
+    if args.append:
+        from ipa import store
+
+        built = store.append(stats, f'{os.path.splitext(args.out)[0]}.parquet')
+        print(f"appended {len(stats)} rows to {args.out}: store version {built['version']}")
+    else:
+        stats.to_csv(args.out, index=False)
+        print(f'wrote {args.out}: {len(stats)} rows')
+    # dissolve the sections here, in parallel for large schemes, rather than in the dashboard server
+    geometry.load_sections(args.blocks, processes=None)
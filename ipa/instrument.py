@@ -0,0 +1,255 @@
+"""Timing and memory instrumentation of the dashboard's hot paths.
+
+Instrumentation is off unless the ``IPA_INSTRUMENT`` environment variable is
+set: ``1`` records the wall time of every stage, ``memory`` also traces the
+memory each stage allocates and keeps (with ``tracemalloc``, which slows
+everything down). When it is off, :func:`stage` returns a shared no-op
+context manager and :func:`timed` functions cost one flag check per call.
+
+Stages are aggregated per process (count, total, maximum) and, for stages run
+by a page's script thread, attributed to the current rerun of the session.
+Every finished rerun is logged as one JSON line on the ``ipa.metrics``
+logger, and with ``IPA_METRICS_PORT`` set the process totals are served at
+``/metrics`` (Prometheus text format) and ``/metrics.json``.
+"""
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+MODE = os.environ.get('IPA_INSTRUMENT', '0')
+ENABLED = MODE not in ('', '0')
+TRACE_MEMORY = MODE == 'memory'
+METRICS_PORT = os.environ.get('IPA_METRICS_PORT')
+
+log = logging.getLogger('ipa.metrics')
+
+_NULL = contextlib.nullcontext()
+_stats = {}
+_lock = threading.Lock()
+_local = threading.local()
+_server = None
+
+
+class StageStats:
+    """Process totals of one stage."""
+    __slots__ = ('count', 'total', 'max', 'memory')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.memory = 0
+
+    def add(self, seconds, memory):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.memory += memory
+
+    def as_dict(self):
+        return {'count': self.count, 'total': round(self.total, 6), 'max': round(self.max, 6),
+                'mean': round(self.total / self.count, 6) if self.count else 0.0, 'memory': self.memory}
+
+
+def _traced_memory():
+    import tracemalloc
+
+    return tracemalloc.get_traced_memory()[0]
+
+
+def record(name, seconds, memory=0):
+    """Add one run of a stage to the process totals and the current rerun."""
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = StageStats()
+        stats.add(seconds, memory)
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is not None:
+        stages = rerun['stages']
+        seconds_so_far, memory_so_far = stages.get(name, (0.0, 0))
+        stages[name] = (seconds_so_far + seconds, memory_so_far + memory)
+
+
+class _Stage:
+    __slots__ = ('name', 'start', 'memory')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.memory = _traced_memory() if TRACE_MEMORY else 0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        memory = _traced_memory() - self.memory if TRACE_MEMORY else 0
+        record(self.name, seconds, memory)
+        return False
+
+
+def stage(name):
+    """Context manager timing a block of code as the stage ``name``."""
+    return _Stage(name) if ENABLED else _NULL
+
+
+def timed(name=None):
+    """Decorator timing every call of a function as a stage (by default its name)."""
+    def decorate(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with _Stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def enable(mode='1'):
+    """Turn instrumentation on (``'1'`` or ``'memory'``) or off (``'0'``) at runtime."""
+    global MODE, ENABLED, TRACE_MEMORY
+    MODE, ENABLED, TRACE_MEMORY = mode, mode not in ('', '0'), mode == 'memory'
+    if TRACE_MEMORY:
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+def _max_rss():
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def begin_rerun(session_state, page):
+    """Start attributing stages of this script thread to a rerun of a session.
+
+    Returns
+    -------
+    dict or None
+        The rerun record, ``None`` when instrumentation is off.
+    """
+    if not ENABLED:
+        return None
+    if METRICS_PORT and _server is None:
+        serve(int(METRICS_PORT))
+    session = session_state.setdefault('_ipa_session', uuid.uuid4().hex[:12])
+    reruns = session_state['_ipa_reruns'] = session_state.get('_ipa_reruns', 0) + 1
+    _local.rerun = {'session': session, 'page': page, 'rerun': reruns, 'stages': {},
+                    'start': time.perf_counter()}
+    return _local.rerun
+
+
+def end_rerun():
+    """Finish and log the current rerun of this script thread.
+
+    Returns
+    -------
+    dict or None
+        The finished rerun record, ``None`` if no rerun was started.
+    """
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is None:
+        return None
+    _local.rerun = None
+    rerun['seconds'] = time.perf_counter() - rerun.pop('start')
+    rerun['max_rss'] = _max_rss()
+    record(f"rerun {rerun['page']}", rerun['seconds'])
+    log.info(json.dumps({'event': 'rerun', **rerun,
+                         'seconds': round(rerun['seconds'], 6),
+                         'stages': {k: {'seconds': round(s, 6), 'memory': m}
+                                    for k, (s, m) in rerun['stages'].items()}}))
+    return rerun
+
+
+def snapshot():
+    """Process totals of every stage, by stage name."""
+    with _lock:
+        return {name: stats.as_dict() for name, stats in sorted(_stats.items())}
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def prometheus_text():
+    """Process totals in the Prometheus text exposition format."""
+    def label(name):
+        return name.replace('\\', '\\\\').replace('"', '\\"')
+
+    lines = ['# TYPE ipa_stage_seconds summary', '# TYPE ipa_stage_max_seconds gauge',
+             '# TYPE ipa_stage_memory_bytes gauge']
+    for name, stats in snapshot().items():
+        lines.append(f'ipa_stage_seconds_count{{stage="{label(name)}"}} {stats["count"]}')
+        lines.append(f'ipa_stage_seconds_sum{{stage="{label(name)}"}} {stats["total"]}')
+        lines.append(f'ipa_stage_max_seconds{{stage="{label(name)}"}} {stats["max"]}')
+        lines.append(f'ipa_stage_memory_bytes{{stage="{label(name)}"}} {stats["memory"]}')
+    lines.append(f'ipa_max_rss_bytes {_max_rss()}')
+    return '\n'.join(lines) + '\n'
+
+
+def serve(port, host='127.0.0.1'):
+    """Serve the process totals over HTTP in a daemon thread, once per process."""
+    global _server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = prometheus_text().encode(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = json.dumps(snapshot()).encode(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    with _lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), Handler)
+            threading.Thread(target=_server.serve_forever, daemon=True, name='ipa-metrics').start()
+    return _server
+
+
+def debug_panel(session_state):
+    """End the current rerun and, if the operator opted in, show its timings in the sidebar."""
+    rerun = end_rerun()
+    if rerun is None:
+        return
+    import streamlit as st
+
+    with st.sidebar:
+        if not st.checkbox('Show timings', key='_ipa_debug_panel'):
+            return
+        st.caption(f"session {rerun['session']} · rerun {rerun['rerun']} · "
+                   f"{rerun['seconds'] * 1000:.0f} ms · max RSS {rerun['max_rss'] / 2 ** 20:.0f} MB")
+        st.dataframe([{'stage': name, 'ms': round(seconds * 1000, 1), 'KB': round(memory / 1024)}
+                      for name, (seconds, memory) in sorted(rerun['stages'].items(), key=lambda s: -s[1][0])],
+                     hide_index=True)
+        with st.expander('Process totals'):
+            st.dataframe([{'stage': name, **stats} for name, stats in snapshot().items()], hide_index=True)
+
+
+if TRACE_MEMORY:
+    enable(MODE)
@@ -0,0 +1,115 @@
+"""Process memory budget.
+
+All sessions of a server process share one copy of every scheme's data, its
+geometry and its figures; what grows with the number of sessions is their
+widget state and the figures in flight. With ``IPA_MEMORY_BUDGET_MB`` set,
+:func:`enforce` is called on every rerun and, while the resident memory of
+the process is over the budget, drops what can be rebuilt, cheapest first:
+the serialized figures and API responses, then the data of every loaded
+scheme but the one of the calling session (least recently used first; other
+sessions showing them load them again). The scheme being shown is never
+dropped, so the budget is a target, not a hard limit.
+
+Once dropping has left the process over budget, nothing more can be gained
+until memory grows again: :func:`enforce` does nothing until the resident
+memory has grown ``IPA_MEMORY_RETRY_MB`` (64 by default) beyond what the last
+drop left, so the shared figure cache is not cleared on every rerun. Dropped
+figures are rebuilt when they are next shown; the figure warm-up is not
+restarted, which would only fill the memory again.
+"""
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+
+from ipa import instrument
+
+BUDGET_MB = float(os.environ.get('IPA_MEMORY_BUDGET_MB', 0))
+# growth after a drop before dropping again
+RETRY_MB = float(os.environ.get('IPA_MEMORY_RETRY_MB', 64))
+
+log = logging.getLogger('ipa.memory')
+
+_lock = threading.Lock()
+evictions = 0
+# resident memory left by the last drop
+_after_drop = 0
+
+
+def rss():
+    """Current resident memory of the process in bytes; the peak where it is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return instrument._max_rss()
+
+
+def _release_memory():
+    gc.collect()
+    # return freed heap pages to the OS, where the C library supports it
+    try:
+        import ctypes
+
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+def _steps(keep):
+    from ipa import figures, schemes
+
+    def drop_caches():
+        figures.cache.clear()
+        api = sys.modules.get('ipa.api')
+        if api is not None:
+            api.cache.clear()
+
+    yield drop_caches
+    for opened in schemes.loaded():
+        if opened is not keep:
+            yield lambda opened=opened: schemes.release(opened.scheme.id)
+
+
+def enforce(keep=None, budget_mb=None):
+    """Drop cached data until the process is within the memory budget.
+
+    Parameters
+    ----------
+    keep : ipa.schemes.SchemeData, optional
+        The scheme of the calling session, which is kept loaded; every other
+        loaded scheme may be released.
+    budget_mb : float, optional
+        Budget in MB; ``IPA_MEMORY_BUDGET_MB`` by default, no budget if 0.
+
+    Returns
+    -------
+    bool
+        Whether anything was dropped.
+    """
+    global evictions, _after_drop
+    budget = (BUDGET_MB if budget_mb is None else budget_mb) * 2 ** 20
+    current = rss()
+    if not budget or current <= budget or current <= _after_drop + RETRY_MB * 2 ** 20:
+        return False
+    # one session evicts, the others carry on
+    if not _lock.acquire(blocking=False):
+        return False
+    try:
+        start, before = time.perf_counter(), rss()
+        dropped = False
+        for step in _steps(keep):
+            if rss() <= budget:
+                break
+            step()
+            _release_memory()
+            dropped = True
+        evictions += dropped
+        _after_drop = rss()
+        instrument.record('enforce memory budget', time.perf_counter() - start)
+        log.info('memory budget %.0f MB: %.0f MB -> %.0f MB', budget / 2 ** 20, before / 2 ** 20, rss() / 2 ** 20)
+        return dropped
+    finally:
+        _lock.release()
@@ -0,0 +1,48 @@
+"""Dashboard panels that are rebuilt only when their selections change.
+
+Every panel of a page (the gains/losses, the map, the bar chart and the
+ranked table) declares the selections and data version it depends on, and
+:func:`memo` keeps the last thing it built for them, per session: a rerun
+caused by a selection a panel does not depend on (the year, for the all-years
+bar chart) re-emits the panel from what it built before instead of looking
+up, deserializing or slicing anything again.
+
+Streamlit reruns the whole script when a sidebar widget changes, so every
+panel is still written out on such a rerun; interactions within a panel (a
+click on the map) rerun only that panel, which the pages wrap in
+``st.fragment``.
+"""
+import streamlit as st
+
+from ipa import instrument
+
+_KEY = '_ipa_panels'
+
+
+def memo(name, depends_on, build):
+    """What ``build()`` returns for the panel ``name`` and the values it ``depends_on``.
+
+    Parameters
+    ----------
+    name : str
+        Panel name, unique within a page.
+    depends_on : tuple
+        The selections and data versions the panel is built from; ``build``
+        is called again only when they change. All pages share the session,
+        so this includes the page's level.
+    build : callable
+        Builds the panel's payload (a figure, a frame, ...) without writing
+        anything to the page.
+    """
+    built = st.session_state.setdefault(_KEY, {})
+    cached = built.get(name)
+    if cached is not None and cached[0] == depends_on:
+        if instrument.ENABLED:
+            instrument.record(f'panel {name} reused', 0.0)
+        return cached[1]
+    with instrument.stage(f'panel {name}'):
+        payload = build()
+    # one payload per panel and session: only the current selection is kept
+    built[name] = (depends_on, payload)
+    return payload
+
@@ -0,0 +1,161 @@
+"""Registry of the irrigation schemes served by the dashboard.
+
+Every scheme is described in ``data/schemes.json`` (or the file named by the
+``IPA_SCHEMES`` environment variable) by its id, name, title, statistics CSV,
+block GeoJSON, map centre and zoom; file paths are relative to the registry
+file. A scheme's data is loaded only when it is opened, and at most
+``IPA_MAX_SCHEMES`` (default 8) schemes are kept loaded per process; opening
+another one releases the least recently used scheme and everything derived
+from it.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from ipa import data
+
+REGISTRY = os.environ.get('IPA_SCHEMES', os.path.join(data.DATA_DIR, 'schemes.json'))
+MAX_LOADED = int(os.environ.get('IPA_MAX_SCHEMES', 8))
+
+_registries = {}
+_loaded = OrderedDict()
+_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class Scheme:
+    """Metadata of one irrigation scheme."""
+    id: str
+    name: str
+    title: str
+    stats: str
+    blocks: str
+    lat: float
+    lon: float
+    zoom: float
+
+    @property
+    def center(self):
+        return {"lat": self.lat, "lon": self.lon}
+
+    @property
+    def store_path(self):
+        return f'{os.path.splitext(self.stats)[0]}.parquet'
+
+    @property
+    def sketches_path(self):
+        from ipa.sketches import sketches_path
+
+        return sketches_path(self.stats)
+
+
+def _parse_registry(raw):
+    return json.loads(raw)['schemes']
+
+
+def registry(path=REGISTRY):
+    """Registered schemes by id, in registry order."""
+    key = (os.path.abspath(path), data.file_digest(path))
+    schemes = _registries.get(key)
+    if schemes is None:
+        base = os.path.dirname(os.path.abspath(path))
+        schemes = {e['id']: Scheme(id=e['id'], name=e['name'], title=e.get('title', e['name']),
+                                   stats=os.path.join(base, e['stats']),
+                                   blocks=os.path.join(base, e['blocks']),
+                                   lat=e['center']['lat'], lon=e['center']['lon'], zoom=e['zoom'])
+                   for e in data.cached_parse(path, _parse_registry)}
+        _registries.clear()
+        _registries[key] = schemes
+    return schemes
+
+
+def get_scheme(scheme_id=None, path=REGISTRY):
+    """A registered scheme; the first one if ``scheme_id`` is not given."""
+    schemes = registry(path)
+    if scheme_id is None:
+        return next(iter(schemes.values()))
+    return schemes[scheme_id]
+
+
+class SchemeData:
+    """Lazily loaded data of an opened scheme.
+
+    All loaders are shared, version-checked caches keyed by the scheme's
+    files, so holding a ``SchemeData`` does not pin stale data.
+    """
+
+    def __init__(self, scheme):
+        self.scheme = scheme
+        self.released = False
+
+    def manifest(self):
+        from ipa.store import manifest
+
+        return manifest(self.scheme.store_path)
+
+    @property
+    def cube(self):
+        from ipa.cube import load_cube
+
+        return load_cube(self.scheme.store_path, self.scheme.name, self.scheme.blocks, self.scheme.sketches_path)
+
+    def geometry(self, level='block', zoom=None):
+        from ipa.geometry import load_geometry
+
+        return load_geometry(level, zoom, self.scheme.blocks)
+
+    def spatial_index(self, level='block'):
+        from ipa.spatial import load_index
+
+        return load_index(level, self.scheme.blocks)
+
+    def locate(self, lon, lat, level='block'):
+        """Properties of the block (or section) containing a point, or ``None``."""
+        return self.spatial_index(level).locate(lon, lat)
+
+    def release(self):
+        """Drop everything cached for this scheme."""
+        from ipa import cube, figures, geometry, spatial
+
+        self.released = True
+        cube.evict(self.scheme.store_path)
+        geometry.evict(self.scheme.blocks)
+        spatial.evict(self.scheme.blocks)
+        figures.cache.discard(self.scheme.id)
+        for path in (self.scheme.stats, self.scheme.blocks, self.scheme.sketches_path):
+            data.evict(path)
+
+
+def open_scheme(scheme):
+    """Data of a scheme, loading it on first use and evicting the least recently used one."""
+    if isinstance(scheme, str):
+        scheme = get_scheme(scheme)
+    with _lock:
+        opened = _loaded.get(scheme.id)
+        if opened is not None and opened.scheme == scheme:
+            _loaded.move_to_end(scheme.id)
+            return opened
+        opened = _loaded[scheme.id] = SchemeData(scheme)
+        _loaded.move_to_end(scheme.id)
+        evicted = []
+        while len(_loaded) > MAX_LOADED:
+            evicted.append(_loaded.popitem(last=False)[1])
+    for old in evicted:
+        old.release()
+    return opened
+
+
+def loaded():
+    """The opened schemes, least recently used first."""
+    with _lock:
+        return list(_loaded.values())
+
+
+def release(scheme_id):
+    """Release an opened scheme and everything derived from it."""
+    with _lock:
+        opened = _loaded.pop(scheme_id, None)
+    if opened is not None:
+        opened.release()
@@ -0,0 +1,219 @@
+"""Quantile sketches of the pixel values of every block.
+
+A sketch is a fixed-bin histogram of the valid pixels of one block, year and
+indicator. All sketches of an indicator and year share the same bin edges,
+covering that year's values, so the sketch of a section or of the whole
+scheme is the sum of the sketches of its blocks, and percentiles of any
+level are read from the merged histograms by linear interpolation within
+the bin, clamped to the exact minimum and maximum. The interpolated and the
+exact percentile lie in the same bin, so for values within the edges a
+percentile is off by less than one bin width, 1/64 of the value range.
+
+:mod:`ipa.ingest` writes the sketches of a statistics CSV next to it as
+``<name>.sketches``: a small JSON header (blocks, years, indicators, bin
+edges) followed by the zlib-compressed bin counts in the narrowest unsigned
+integer type that holds them.
+"""
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from ipa import data
+
+BINS = 64
+# percentile statistics offered when a scheme has sketches
+PERCENTILES = {'p10': 0.10, 'p50': 0.50, 'p90': 0.90}
+STATS = tuple(PERCENTILES)
+
+_MAGIC = b'IPAQ\x01'
+
+
+def sketches_path(stats_path):
+    """Path of the sketches of a statistics CSV."""
+    return f'{os.path.splitext(stats_path)[0]}.sketches'
+
+
+def bin_edges(low, high, bins=BINS):
+    """``bins + 1`` edges covering ``[low, high]``; a single value gets a unit-wide range."""
+    if not high > low:
+        low, high = low - 0.5, high + 0.5
+    return np.linspace(low, high, bins + 1)
+
+
+def quantiles(counts, edges, q, low=None, high=None):
+    """Quantile ``q`` of every histogram in ``counts``.
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        (..., bins) histograms on ``edges``.
+    edges : numpy.ndarray
+        ``bins + 1`` bin edges, or (..., bins + 1) edges of every histogram.
+    q : float
+        Quantile in ``[0, 1]``.
+    low, high : numpy.ndarray, optional
+        Exact minimum and maximum of every histogram (shape ``counts.shape[:-1]``);
+        the tails of values outside the edges are counted in the end bins.
+
+    Returns
+    -------
+    numpy.ndarray
+        Shape ``counts.shape[:-1]``, NaN for empty histograms.
+    """
+    counts = np.asarray(counts, dtype=float)
+    cumulative = np.cumsum(counts, axis=-1)
+    total = cumulative[..., -1]
+    target = q * total
+    # the first bin reaching the target, interpolating linearly within it
+    k = np.minimum((cumulative < target[..., None]).sum(axis=-1), counts.shape[-1] - 1)
+    below = np.where(k > 0, np.take_along_axis(cumulative, np.maximum(k - 1, 0)[..., None], -1)[..., 0], 0.0)
+    in_bin = np.take_along_axis(counts, k[..., None], -1)[..., 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = np.where(in_bin > 0, (target - below) / in_bin, 0.0)
+    edges = np.broadcast_to(edges, counts.shape[:-1] + (counts.shape[-1] + 1,))
+    lower = np.take_along_axis(edges, k[..., None], -1)[..., 0]
+    upper = np.take_along_axis(edges, k[..., None] + 1, -1)[..., 0]
+    value = lower + fraction * (upper - lower)
+    if low is not None:
+        value = np.fmax(value, low)
+    if high is not None:
+        value = np.fmin(value, high)
+    return np.where(total > 0, value, np.nan)
+
+
+class QuantileSketches:
+    """Histograms of every block, year and indicator.
+
+    Parameters
+    ----------
+    blocks : sequence of str
+        Block names, in the order of the first axis of ``counts``.
+    years : sequence of int
+    indicators : sequence of str
+    edges : numpy.ndarray
+        (years x indicators x bins + 1) bin edges of every year and
+        indicator; (indicators x bins + 1) edges are shared by all years.
+    counts : numpy.ndarray
+        (blocks x years x indicators x bins) pixel counts.
+    """
+
+    def __init__(self, blocks, years, indicators, edges, counts):
+        self.blocks = np.asarray(blocks, dtype=str)
+        self.years = [int(y) for y in years]
+        self.indicators = list(indicators)
+        edges = np.asarray(edges, dtype=float)
+        if edges.ndim == 2:
+            edges = np.repeat(edges[None], len(self.years), axis=0)
+        self.edges = edges
+        self.counts = counts
+
+    def encode(self):
+        """Compact binary form, see the module docstring."""
+        counts = self.counts
+        dtype = next(t for t in (np.uint8, np.uint16, np.uint32, np.uint64) if counts.max(initial=0) <= np.iinfo(t).max)
+        header = json.dumps({'blocks': self.blocks.tolist(), 'years': self.years, 'indicators': self.indicators,
+                             'edges': self.edges.tolist(), 'shape': counts.shape,
+                             'dtype': np.dtype(dtype).str}).encode()
+        body = zlib.compress(np.ascontiguousarray(counts, dtype=dtype).tobytes(), 6)
+        return _MAGIC + struct.pack('<I', len(header)) + header + body
+
+    @classmethod
+    def decode(cls, raw):
+        if not raw.startswith(_MAGIC):
+            raise ValueError('not a quantile sketch file')
+        offset = len(_MAGIC) + 4
+        (size,) = struct.unpack('<I', raw[len(_MAGIC):offset])
+        header = json.loads(raw[offset:offset + size])
+        counts = np.frombuffer(zlib.decompress(raw[offset + size:]), dtype=header['dtype'])
+        return cls(header['blocks'], header['years'], header['indicators'], header['edges'],
+                   counts.reshape(header['shape']))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.encode())
+
+    def merged(self, other):
+        """These sketches with the blocks and years of ``other`` added or replaced.
+
+        Both must share the bin edges of their common years and indicators.
+        """
+        indicators = self.indicators + [i for i in other.indicators if i not in self.indicators]
+        blocks = list(dict.fromkeys(self.blocks.tolist() + other.blocks.tolist()))
+        years = sorted(set(self.years) | set(other.years))
+        # edges of a year and indicator neither has are never read: its counts stay zero
+        edges = np.tile(bin_edges(0.0, 1.0, self.counts.shape[-1]), (len(years), len(indicators), 1))
+        for sketches in (self, other):
+            for j, year in enumerate(sketches.years):
+                for k, indicator in enumerate(sketches.indicators):
+                    y, i = years.index(year), indicators.index(indicator)
+                    if sketches is other and year in self.years and indicator in self.indicators \
+                            and not np.allclose(edges[y, i], other.edges[j, k]):
+                        raise ValueError(f'sketches of {indicator} in {year} have different bin edges')
+                    edges[y, i] = sketches.edges[j, k]
+        counts = np.zeros((len(blocks), len(years), len(indicators), self.counts.shape[-1]),
+                          dtype=np.result_type(self.counts, other.counts))
+        for sketches in (self, other):
+            b = [blocks.index(x) for x in sketches.blocks]
+            y = [years.index(x) for x in sketches.years]
+            i = [indicators.index(x) for x in sketches.indicators]
+            # the rows of other replace those of self
+            counts[np.ix_(b, y, i)] = sketches.counts
+        return QuantileSketches(blocks, years, indicators, edges, counts)
+
+    def percentiles(self, section_of, extremes, scheme_name='scheme', years=None):
+        """Percentile statistics of every level from the merged block histograms.
+
+        Parameters
+        ----------
+        section_of : pandas.Series
+            Section of every block.
+        extremes : dict
+            For every level a frame indexed like :func:`ipa.cube.aggregate`'s
+            with the exact ``min`` and ``max`` rows the percentiles are clamped to.
+        years : iterable of int, optional
+            Only these years.
+
+        Returns
+        -------
+        dict
+            For every level a DataFrame indexed by (indicator, stat, name)
+            with one column per year, stats as in :data:`PERCENTILES`.
+        """
+        y = [j for j, year in enumerate(self.years) if years is None or year in set(years)]
+        year_labels = [self.years[j] for j in y]
+        counts = self.counts[:, y]
+        sections, codes = np.unique(section_of.reindex(self.blocks).fillna('').to_numpy(dtype=str),
+                                    return_inverse=True)
+        merged = np.zeros((len(sections),) + counts.shape[1:])
+        np.add.at(merged, codes, counts)
+        levels = {'block': (self.blocks, counts), 'section': (sections, merged),
+                  'scheme': (np.array([scheme_name]), counts.sum(axis=0, keepdims=True, dtype=float))}
+        frames = {}
+        for level, (names, level_counts) in levels.items():
+            keep = names != ''
+            rows = []
+            for i, indicator in enumerate(self.indicators):
+                bounds = {}
+                for stat in ('min', 'max'):
+                    try:
+                        bounds[stat] = extremes[level].loc[(indicator, stat)].reindex(
+                            index=names[keep], columns=year_labels).to_numpy(dtype=float)
+                    except KeyError:
+                        bounds[stat] = None
+                for stat, q in PERCENTILES.items():
+                    values = quantiles(level_counts[keep, :, i], self.edges[y, i], q, bounds['min'], bounds['max'])
+                    index = pd.MultiIndex.from_product([[indicator], [stat], names[keep]])
+                    rows.append(pd.DataFrame(values, index=index, columns=year_labels))
+            frames[level] = pd.concat(rows) if rows else pd.DataFrame(columns=year_labels)
+        return frames
+
+
+def load_sketches(path):
+    """Sketches of a file, ``None`` if there is none; re-read only when the file changes."""
+    if path is None or not os.path.exists(path):
+        return None
+    return data.cached_parse(path, QuantileSketches.decode)
@@ -0,0 +1,82 @@
+"""Spatial index over block and section polygons.
+
+An STRtree over the polygons of a scheme answers point lookups ("which block
+contains this coordinate") without scanning every feature. Indexes are built
+once per block file version and shared by all sessions.
+"""
+import os
+import threading
+
+from ipa import data
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+class SpatialIndex:
+    """STRtree over the features of a GeoJSON ``FeatureCollection``.
+
+    Parameters
+    ----------
+    geo : dict
+        Polygons as a GeoJSON ``FeatureCollection``.
+    """
+
+    def __init__(self, geo):
+        from shapely import STRtree
+        from shapely.geometry import shape
+
+        self.properties = [f['properties'] for f in geo['features']]
+        self.geometries = [shape(f['geometry']) for f in geo['features']]
+        self.tree = STRtree(self.geometries)
+
+    def locate(self, lon, lat):
+        """Properties of the polygon containing a point, or ``None``."""
+        from shapely.geometry import Point
+
+        hits = self.tree.query(Point(lon, lat), predicate='intersects')
+        return self.properties[min(hits)] if len(hits) else None
+
+
+def selected_locations(event):
+    """Feature ids clicked on a map shown with ``st.plotly_chart(on_select=...)``."""
+    try:
+        points = event.selection.points
+    except AttributeError:
+        return []
+    return [p['location'] for p in points if p.get('location') is not None]
+
+
+def parse_coordinates(text):
+    """``(lon, lat)`` of a ``"lat, lon"`` string, or ``None`` if it is not one."""
+    try:
+        lat, lon = (float(v) for v in text.replace(';', ',').split(','))
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lon, lat
+
+
+def load_index(level='block', blocks_path=data.BLOCKS_JSON):
+    """Spatial index of the full-precision block or section polygons of a block file."""
+    from ipa.geometry import load_geometry
+
+    path = os.path.abspath(blocks_path)
+    key = (path, data.file_digest(blocks_path), level)
+    index = _indexes.get(key)
+    if index is None:
+        index = SpatialIndex(load_geometry(level, blocks_path=blocks_path))
+        with _lock:
+            for old in [k for k in _indexes if k[0] == path and k[1] != key[1]]:
+                del _indexes[old]
+            _indexes[key] = index
+    return index
+
+
+def evict(blocks_path):
+    """Forget the indexes of a block file."""
+    path = os.path.abspath(blocks_path)
+    with _lock:
+        for key in [k for k in _indexes if k[0] == path]:
+            del _indexes[key]
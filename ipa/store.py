@@ -0,0 +1,379 @@
+"""Long-format columnar store of the indicator statistics.
+
+The wide statistics CSV (one column per indicator and statistic) is converted
+to a Parquet dataset with one row per year, section, block, indicator and
+statistic. The dataset is partitioned by year, names are dictionary encoded
+and values are stored as float32. Reads are memory-mapped and only the
+requested columns and the row groups/partitions matching the selected year,
+indicator and statistic are read.
+
+The store is versioned. Its manifest holds a dataset ``version`` that grows
+with every change and, for every year partition, the version it last changed
+in, a hash of its content and its file. Syncing from the CSV or appending
+new statistics rewrites only the year partitions whose content changed and
+writes them to new files, so readers holding the previous manifest keep a
+consistent snapshot. Caches derived from the store use these versions to
+recompute only the affected years.
+
+The store is synced from the CSV on first use and whenever the CSV changes;
+``python -m ipa.store`` syncs it ahead of time and ``--append`` adds the
+statistics of new seasons or blocks. Writers (dashboard processes, the ingest
+and this module's command line) take an exclusive lock on ``<store>.lock``
+while they write the store or its CSV, and decide what to write only once
+they hold it, so concurrent syncs and appends never overwrite or delete each
+other's partitions. Where the data directory is read-only and the store is
+missing or stale, the dashboard syncs a copy in the temporary directory and
+reads that instead.
+"""
+import contextlib
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers of one process are still serialized
+    fcntl = None
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.parquet as pq
+
+from ipa import data, instrument
+
+STATS = ('mean', 'min', 'max', 'std')
+# pixel count of a block's statistics, the weight of merged section and scheme statistics
+COUNT = 'count'
+KEY_COLUMNS = ['year', 'section_name', 'block']
+STORE_PATH = f'{os.path.splitext(data.STATS_CSV)[0]}.parquet'
+MANIFEST = '_manifest.json'
+
+log = logging.getLogger('ipa.store')
+
+SCHEMA = pa.schema([
+    ('section_name', pa.dictionary(pa.int32(), pa.string())),
+    ('block', pa.dictionary(pa.int32(), pa.string())),
+    ('indicator', pa.dictionary(pa.int32(), pa.string())),
+    ('stat', pa.dictionary(pa.int32(), pa.string())),
+    ('value', pa.float32()),
+])
+PARTITIONING = ds.partitioning(pa.schema([('year', pa.int16())]), flavor='hive')
+
+_column_re = re.compile(rf"^(?P<indicator>.+)_(?P<stat>{'|'.join(STATS + (COUNT,))})$")
+_lock = threading.Lock()
+# stores read from a copy because their own directory is read-only
+_redirects = {}
+_filesystem = pyarrow.fs.LocalFileSystem(use_mmap=True)
+
+
+def split_column(column):
+    """Split a wide column name such as ``seasonal_yield_mean`` into indicator and statistic."""
+    match = _column_re.match(column)
+    if match is None:
+        raise ValueError(f'not an indicator statistic column: {column!r}')
+    return match['indicator'], match['stat']
+
+
+def wide_to_long(df):
+    """Melt a wide statistics frame to one row per indicator and statistic."""
+    value_columns = [c for c in df.columns if c not in KEY_COLUMNS]
+    long = df.melt(id_vars=KEY_COLUMNS, value_vars=value_columns, var_name='column', value_name='value')
+    parts = long['column'].str.extract(_column_re)
+    long = long.drop(columns='column').assign(indicator=parts['indicator'], stat=parts['stat'])
+    long = long.sort_values(['year', 'indicator', 'stat', 'section_name', 'block'], kind='stable')
+    return long[['year', 'section_name', 'block', 'indicator', 'stat', 'value']].reset_index(drop=True)
+
+
+def long_to_wide(long, column_order=None):
+    """Inverse of :func:`wide_to_long`."""
+    long = long.assign(column=long['indicator'].astype(str) + '_' + long['stat'].astype(str))
+    wide = long.pivot_table(index=KEY_COLUMNS, columns='column', values='value', observed=True, sort=False)
+    wide = wide.reset_index()
+    wide.columns.name = None
+    if column_order is not None:
+        wide = wide[KEY_COLUMNS + [c for c in column_order if c in wide.columns]]
+    return wide
+
+
+def _partition_hash(wide_year):
+    rows = wide_year.sort_values(['section_name', 'block']).to_csv(index=False)
+    return hashlib.sha1(rows.encode()).hexdigest()
+
+
+def _write_partition(wide_year, store_path, year, version):
+    long = wide_to_long(wide_year)
+    table = pa.Table.from_pandas(long.drop(columns='year'), schema=SCHEMA, preserve_index=False)
+    name = f'year={year}/part-v{version}.parquet'
+    os.makedirs(os.path.join(store_path, f'year={year}'), exist_ok=True)
+    pq.write_table(table, os.path.join(store_path, name), row_group_size=4096)
+    return name
+
+
+def _write_manifest(store_path, manifest):
+    path = os.path.join(store_path, MANIFEST)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, path)
+
+
+def _parse_manifest(raw):
+    manifest = json.loads(raw)
+    manifest['partitions'] = {int(y): p for y, p in manifest['partitions'].items()}
+    return manifest
+
+
+def _read_manifest(store_path):
+    path = os.path.join(store_path, MANIFEST)
+    return data.cached_parse(path, _parse_manifest) if os.path.exists(path) else None
+
+
+@contextlib.contextmanager
+def _write_lock(store_path):
+    """Exclusive lock of a store across the threads and processes writing it."""
+    with _lock, open(f'{store_path}.lock', 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _remove_stale_files(store_path, manifest, previous):
+    # files of the previous version are kept for readers still holding it
+    keep = {p['file'] for m in (manifest, previous) if m for p in m['partitions'].values()}
+    for path in glob.glob(os.path.join(store_path, 'year=*', '*.parquet')):
+        if os.path.relpath(path, store_path) not in keep:
+            os.remove(path)
+
+
+@instrument.timed()
+def update_store(wide, store_path=STORE_PATH, replace=True, source_hash=None):
+    """Write statistics to the store, rewriting only the year partitions that change.
+
+    Parameters
+    ----------
+    wide : pandas.DataFrame
+        Statistics in the wide CSV layout.
+    store_path : str
+        Local path of the Parquet store.
+    replace : bool
+        If true ``wide`` is the complete dataset and years missing from it are
+        removed. Otherwise its rows are appended: rows of the same year and
+        block replace the stored ones and all other rows are kept.
+    source_hash : str, optional
+        Content hash of the CSV the store is synced with.
+
+    Returns
+    -------
+    dict
+        The new manifest.
+    """
+    with _write_lock(store_path):
+        return _update_store(wide, store_path, replace, source_hash)
+
+
+def _update_store(wide, store_path, replace, source_hash):
+    previous = _read_manifest(store_path)
+    partitions = dict(previous['partitions']) if previous else {}
+    version = previous['version'] + 1 if previous else 1
+    columns = list(previous['columns']) if previous and not replace else []
+    columns += [c for c in wide.columns if c not in KEY_COLUMNS and c not in columns]
+
+    changed = False
+    for year, rows in wide.groupby('year', sort=True):
+        year = int(year)
+        if not replace and year in partitions:
+            stored = long_to_wide(load_long(year=year, store_path=store_path, snapshot=previous))
+            stored = stored.astype({'section_name': str, 'block': str})
+            rows = pd.concat([stored[~stored['block'].isin(rows['block'])], rows], ignore_index=True)
+        rows = rows.reindex(columns=KEY_COLUMNS + columns)
+        digest = _partition_hash(rows)
+        if partitions.get(year, {}).get('hash') != digest:
+            partitions[year] = dict(version=version, hash=digest,
+                                    file=_write_partition(rows, store_path, year, version))
+            changed = True
+    if replace:
+        for year in set(partitions) - {int(y) for y in wide['year'].unique()}:
+            del partitions[year]
+            changed = True
+
+    if not changed and previous is not None:
+        if source_hash is None or previous.get('source_hash') == source_hash:
+            return previous
+        version = previous['version']
+    manifest = dict(version=version,
+                    source_hash=source_hash if source_hash else (previous or {}).get('source_hash'),
+                    years=sorted(partitions), columns=columns,
+                    partitions={str(y): p for y, p in sorted(partitions.items())})
+    _write_manifest(store_path, manifest)
+    _remove_stale_files(store_path, manifest, previous)
+    return _read_manifest(store_path)
+
+
+def build_store(csv_path=data.STATS_CSV, store_path=STORE_PATH):
+    """Sync the long Parquet store with the wide statistics CSV.
+
+    Returns
+    -------
+    dict
+        The manifest of the store.
+    """
+    return update_store(data.load_stats(csv_path), store_path, replace=True,
+                        source_hash=data.file_digest(csv_path))
+
+
+def source_csv(store_path):
+    """Path of the wide CSV a store is synced with: the store path with a ``.csv`` extension."""
+    return f'{os.path.splitext(store_path)[0]}.csv'
+
+
+def append(wide, store_path=STORE_PATH, update_csv=True):
+    """Append the statistics of new years or blocks to the store and the CSV.
+
+    Rows of a year and block already in the store replace the stored ones.
+    Only the year partitions in ``wide`` are rewritten. Unless ``update_csv``
+    is false the rows are also merged into the store's CSV (:func:`source_csv`).
+
+    Returns
+    -------
+    dict
+        The new manifest.
+    """
+    csv_path = source_csv(store_path)
+    with _write_lock(store_path):
+        if not (update_csv and os.path.exists(csv_path)):
+            return _update_store(wide, store_path, False, None)
+        previous = _read_manifest(store_path)
+        synced_before = previous is not None and previous['source_hash'] == data.file_digest(csv_path)
+        # merge into the CSV, the checked-in source of the store, and write the
+        # changed years from it so the partition hashes match a later full sync
+        keys = ['year', 'block']
+        current = data.load_stats(csv_path)
+        kept = current.merge(wide[keys], on=keys, how='left', indicator=True)
+        kept = kept[kept['_merge'] == 'left_only'].drop(columns='_merge')
+        merged = pd.concat([kept, wide], ignore_index=True).sort_values('year', kind='stable')
+        merged = merged.reindex(columns=KEY_COLUMNS + [c for c in merged.columns if c not in KEY_COLUMNS])
+        tmp = f'{csv_path}.{os.getpid()}.tmp'
+        # in the file's own line endings, so only the appended rows show up as changed
+        merged.to_csv(tmp, index=False, lineterminator=_line_terminator(csv_path))
+        os.replace(tmp, csv_path)
+        synced = data.load_stats(csv_path)
+        if not synced_before:
+            # a missing or stale store gets all years of the CSV, not only the appended ones
+            return _update_store(synced, store_path, True, data.file_digest(csv_path))
+        return _update_store(synced[synced['year'].isin(wide['year'].unique())], store_path,
+                             False, data.file_digest(csv_path))
+
+
+def _line_terminator(path):
+    with open(path, 'rb') as f:
+        return '\r\n' if f.readline().endswith(b'\r\n') else '\n'
+
+
+def _location(store_path):
+    """Where a store is read from: its own path or, if that is read-only, its copy."""
+    return _redirects.get(os.path.abspath(store_path), store_path)
+
+
+def _fallback_path(store_path):
+    key = hashlib.sha1(os.path.abspath(store_path).encode()).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), 'ipa-store', f'{os.path.basename(store_path)}-{key}')
+
+
+def manifest(store_path=STORE_PATH, csv_path=None):
+    """Manifest of the store, syncing the store from its CSV (:func:`source_csv`) if needed.
+
+    The manifest holds the dataset ``version``, the ``years`` and the wide
+    ``columns`` (``<indicator>_<stat>``) of the store and its ``partitions``
+    by year.
+    """
+    csv_path = csv_path or source_csv(store_path)
+    location = _location(store_path)
+    current = _read_manifest(location)
+    if current is not None and (not os.path.exists(csv_path)
+                                or current['source_hash'] == data.file_digest(csv_path)):
+        return current
+    try:
+        # another thread or process may have synced it meanwhile, which update_store sees under its lock
+        return build_store(csv_path, location)
+    except OSError as error:
+        if location != store_path:
+            raise
+        fallback = _fallback_path(store_path)
+        log.warning('cannot write the store %s (%s); syncing a copy in %s', store_path, error, fallback)
+        os.makedirs(os.path.dirname(fallback), exist_ok=True)
+        built = build_store(csv_path, fallback)
+        _redirects[os.path.abspath(store_path)] = fallback
+        return built
+
+
+def _as_list(value):
+    return list(value) if isinstance(value, (list, tuple, set)) else [value]
+
+
+def read(columns=None, year=None, indicator=None, stat=None, store_path=STORE_PATH, snapshot=None):
+    """Read rows of the store with column and predicate pushdown.
+
+    Parameters
+    ----------
+    columns : list of str, optional
+        Columns to read. All columns by default.
+    year, indicator, stat : optional
+        A single value or a list of values to keep.
+    store_path : str
+        Local path of the Parquet store.
+    snapshot : dict, optional
+        Manifest of the version to read; the current one by default.
+
+    Returns
+    -------
+    pyarrow.Table
+    """
+    current = snapshot or manifest(store_path)
+    store_path = _location(store_path)
+    years = current['partitions'] if year is None else [int(y) for y in _as_list(year)]
+    files = [os.path.join(store_path, current['partitions'][y]['file'])
+             for y in years if y in current['partitions']]
+    dataset = ds.dataset(files, format='parquet', partitioning=PARTITIONING,
+                         partition_base_dir=store_path, filesystem=_filesystem,
+                         schema=SCHEMA.append(pa.field('year', pa.int16())))
+    expression = None
+    for name, value in (('indicator', indicator), ('stat', stat)):
+        if value is not None:
+            condition = ds.field(name).isin(_as_list(value))
+            expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+def load_long(year=None, indicator=None, stat=None, store_path=STORE_PATH, snapshot=None):
+    """Long-format statistics as a DataFrame with categorical names."""
+    columns = ['year', 'section_name', 'block', 'indicator', 'stat', 'value']
+    return read(columns, year, indicator, stat, store_path, snapshot).to_pandas()[columns]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--csv', default=data.STATS_CSV, help='wide statistics CSV')
+    parser.add_argument('--store', help='Parquet dataset directory, next to the CSV by default')
+    parser.add_argument('--append', metavar='CSV',
+                        help='append the statistics of new years or blocks from this CSV')
+    args = parser.parse_args()
+    args.store = args.store or f'{os.path.splitext(args.csv)[0]}.parquet'
+    if args.append:
+        built = append(pd.read_csv(args.append), args.store)
+    else:
+        built = build_store(args.csv, args.store)
+    print(f"{args.store}: version {built['version']}, {len(built['years'])} years, "
+          f"{len(built['columns'])} indicator columns")
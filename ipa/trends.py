@@ -0,0 +1,151 @@
+"""Linear trends and anomalies of the indicator values over the years.
+
+For every name, indicator and statistic of a level the least-squares slope
+over the years, its t statistic and two-sided p-value, and the z-score of
+every year relative to the name's own history are computed in one batched
+NumPy pass over the year axis of the cube. Years without a value are left
+out of a row's fit. The results are cached on the cube, so they are computed
+once per data version.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from ipa.cube import NAME_COLUMNS
+
+# p-value below which a trend is reported as significant
+SIGNIFICANCE = 0.05
+
+
+def t_pvalue(t, df):
+    """Two-sided p-value of Student's t with integer degrees of freedom.
+
+    Uses the closed forms for integer ``df`` (Abramowitz & Stegun 26.7.3 and
+    26.7.4), evaluated for all rows at once; NaN where ``df < 1``.
+    """
+    t = np.abs(np.asarray(t, dtype=float))
+    df = np.asarray(df, dtype=int)
+    theta = np.arctan(t / np.sqrt(np.maximum(df, 1)))
+    sin, cos2 = np.sin(theta), np.cos(theta) ** 2
+    term_even, sum_even = np.ones_like(t), np.ones_like(t)
+    term_odd, sum_odd = np.ones_like(t), np.where(df >= 3, 1.0, 0.0)
+    for k in range(1, max(int(df.max(initial=0)) // 2, 1)):
+        term_even = term_even * cos2 * (2 * k - 1) / (2 * k)
+        sum_even += np.where(k <= (df - 2) // 2, term_even, 0.0)
+        term_odd = term_odd * cos2 * (2 * k) / (2 * k + 1)
+        sum_odd += np.where(k <= (df - 3) // 2, term_odd, 0.0)
+    probability = np.where(df % 2 == 1, 2 / np.pi * (theta + sin * np.sqrt(cos2) * sum_odd), sin * sum_even)
+    with np.errstate(invalid='ignore'):
+        return np.where(df >= 1, np.clip(1 - probability, 0.0, 1.0), np.nan)
+
+
+def fit_trends(values, years):
+    """Least-squares line through every row of ``values`` against ``years``.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        (rows x years) values, NaN where a year is missing.
+    years : sequence of int
+        The year of every column.
+
+    Returns
+    -------
+    dict of numpy.ndarray
+        ``slope`` (per year), ``intercept`` (at the first year), ``t``, ``p``
+        and ``n`` (the number of years fitted) of every row.
+    """
+    x = np.asarray(years, dtype=float) - years[0]
+    valid = ~np.isnan(values)
+    y = np.where(valid, values, 0.0)
+    n = valid.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_x = (valid * x).sum(axis=1) / n
+        mean_y = y.sum(axis=1) / n
+        dx = np.where(valid, x - mean_x[:, None], 0.0)
+        sxx = (dx * dx).sum(axis=1)
+        slope = (dx * (y - mean_y[:, None])).sum(axis=1) / sxx
+        intercept = mean_y - slope * mean_x
+        residuals = np.where(valid, y - intercept[:, None] - slope[:, None] * x, 0.0)
+        stderr = np.sqrt((residuals * residuals).sum(axis=1) / (n - 2) / sxx)
+        t = slope / stderr
+    slope = np.where(n >= 2, slope, np.nan)
+    # a perfect fit of a sloped line is infinitely significant, of a flat one not at all
+    perfect = np.where(slope == 0, 0.0, np.copysign(np.inf, slope))
+    t = np.where(n > 2, np.where(stderr == 0, perfect, t), np.nan)
+    p = t_pvalue(np.nan_to_num(t, posinf=1e12, neginf=-1e12), n - 2)
+    return {'slope': slope, 'intercept': intercept, 't': t, 'p': np.where(np.isnan(t), np.nan, p), 'n': n}
+
+
+def zscores(values):
+    """Every value's distance from its row's mean in (sample) standard deviations."""
+    # rows with fewer than two values have no z-scores
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(values, axis=1, keepdims=True)
+        std = np.nanstd(values, axis=1, ddof=1, keepdims=True)
+        return (values - mean) / std
+
+
+class TrendEngine:
+    """Trends and anomalies of an indicator cube.
+
+    Parameters
+    ----------
+    cube : ipa.cube.IndicatorCube
+        Cube the trends are computed from.
+    """
+
+    def __init__(self, cube):
+        self.cube = cube
+        self._trends = {}
+        self._anomalies = {}
+
+    def trends(self, level):
+        """Trend of every (indicator, stat, name) of a level.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Indexed like ``cube.wide[level]`` with the columns ``slope``,
+            ``intercept``, ``t``, ``p`` and ``n``.
+        """
+        if level not in self._trends:
+            wide = self.cube.wide[level]
+            fit = fit_trends(wide.to_numpy(dtype=float), list(wide.columns))
+            self._trends[level] = pd.DataFrame(fit, index=wide.index)
+        return self._trends[level]
+
+    def anomalies(self, level):
+        """Z-score of every value of a level, indexed and laid out like ``cube.wide[level]``."""
+        if level not in self._anomalies:
+            wide = self.cube.wide[level]
+            self._anomalies[level] = pd.DataFrame(zscores(wide.to_numpy(dtype=float)),
+                                                  index=wide.index, columns=wide.columns)
+        return self._anomalies[level]
+
+    def _frame(self, level, values, column):
+        name = NAME_COLUMNS[level]
+        frame = values.dropna().sort_values(ascending=False).rename(column).rename_axis(name).reset_index()
+        if level == 'block':
+            frame.insert(0, 'section_name', frame['block'].map(self.cube.section_of))
+        return frame
+
+    def trend(self, level, indicator, stat):
+        """Slope per year of every name, steepest rise first.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The name column(s) of the level as in :meth:`ipa.cube.IndicatorCube.values`,
+            the slope as ``<indicator>_<stat>``, ``p_value`` and ``significant``.
+        """
+        trends = self.trends(level).loc[(indicator, stat)]
+        frame = self._frame(level, trends['slope'], f'{indicator}_{stat}')
+        p = trends['p'].reindex(frame[NAME_COLUMNS[level]]).to_numpy()
+        return frame.assign(p_value=p, significant=p < SIGNIFICANCE)
+
+    def anomaly(self, level, year, indicator, stat):
+        """Z-score of one year of every name, largest first, laid out like :meth:`trend`."""
+        return self._frame(level, self.anomalies(level).loc[(indicator, stat), year], f'{indicator}_{stat}')
@@ -0,0 +1,188 @@
+"""Page layout, texts and sidebar widgets shared by the dashboard pages."""
+import streamlit as st
+
+from ipa import memory
+from ipa.figures import warm_up
+from ipa.schemes import open_scheme, registry
+from ipa.data import load_logo, LOGO_WIDE, LOGO_SMALL
+
+STYLE = """
+<style>
+
+[data-testid="block-container"] {
+    padding-left: 2rem;
+    padding-right: 2rem;
+    padding-top: 1rem;
+    padding-bottom: 0rem;
+    margin-bottom: -7rem;
+}
+
+[data-testid="stVerticalBlock"] {
+    padding-left: 0rem;
+    padding-right: 0rem;
+}
+
+[data-testid="stMetric"] {
+    background-color: #1c1b1b;
+    text-align: center;
+    padding: 2px 0;
+}
+
+[data-testid="stMetricLabel"] {
+  display: flex;
+  justify-content: center;
+  align-items: center;
+}
+
+[data-testid="stMetricDeltaIcon-Up"] {
+    position: relative;
+    left: 38%;
+    -webkit-transform: translateX(-50%);
+    -ms-transform: translateX(-50%);
+    transform: translateX(-50%);
+}
+
+[data-testid="stMetricDeltaIcon-Down"] {
+    position: relative;
+    left: 38%;
+    -webkit-transform: translateX(-50%);
+    -ms-transform: translateX(-50%);
+    transform: translateX(-50%);
+}
+            
+img[data-testid="stLogo"] {
+            height: 4.5rem;
+}
+
+</style>
+"""
+
+HIDE_GITHUB_ICON = """
+<style>
+.css-1jc7ptx, .e1ewe7hr3, .viewerBadge_container__1QSob, .styles_viewerBadge__1yB5_, .viewerBadge_link__1S137, .viewerBadge_text__1JaDK{ display: none; } #MainMenu{ visibility: hidden; } footer { visibility: hidden; } header { visibility: hidden; }
+</style>
+"""
+
+IPA_DESCRIPTION = {
+    "beneficial fraction": ":blue[Beneficial fraction (BF)] is the ratio of the water that is consumed as transpiration\
+         compared to overall field water consumption (ETa). ${\\footnotesize BF = T_a/ET_a}$. \
+         It is a measure of the efficiency of on farm water and agronomic practices in use of water for crop growth.",
+    "crop water deficit": ":blue[crop water deficit (CWD)] is measure of adequacy and calculated as the ration of seasonal\
+        evapotranspiration to potential or reference evapotranspiration ${\\footnotesize CWD= ET_a/ET_p}$",
+    "relative water deficit": ":blue[relative water deficit (RWD)] is also a measure of adequacy which is 1 minus crop water\
+          deficit ${\\footnotesize RWD= 1-ET_a/ET_p}$",
+    "total seasonal biomass production": ":blue[total seasonal biomass production (TBP)] is total biomass produced in tons. \
+        ${\\footnotesize TBP = (NPP * 22.222) / 1000}$",
+    "seasonal yield": ":blue[seasonal yield] is the yield in a season which is crop specific and calculated using \
+        the TBP and yield factors such as moisture content, harvest index, light use efficiency correction \
+            factor and above ground over total biomass production ratio (AOT) \
+                ${\\footnotesize Yiled = TBP*HI*AOT*f_c/(1-MC)}$",
+    "crop water productivity": ":blue[crop water productivity (CWP)] is the seasonal yield per the amount of water \
+        consumed in ${kg/m^3}$"
+}
+
+STAT_DESCRIPTION = {
+    "Average":"The :blue[Average] shows the ${\\textit {mean}}$ of the values of the selected indicator of all the grid cells (20m by 20m)\
+          contained in each block", 
+    "Maximum":"The :blue[Maximum] shows the ${\\textit maximum}$ value of the selected indicator from all the values of grid cells (20m by 20m)\
+          contained in each block", 
+    "Minimum":"The :blue[Minimum] shows the ${\\textit minimum}$ value of the selected indicator from all the values of grid cells (20m by 20m)\
+          contained in each block", 
+    "Standard deviation":"The :blue[Standard deviation] shows the ${\\textit standard deviation}$ of the values of the selected indicator of all the grid \
+        cells (20m by 20m) contained in each block", 
+    "10th percentile":"The :blue[10th percentile] is the value below which the selected indicator lies in a tenth of the \
+        grid cells (20m by 20m) contained in each block",
+    "Median":"The :blue[Median] is the value below which the selected indicator lies in half of the grid cells (20m by 20m)\
+          contained in each block",
+    "90th percentile":"The :blue[90th percentile] is the value below which the selected indicator lies in nine tenths of \
+        the grid cells (20m by 20m) contained in each block",
+}
+
+MAP_LAYER_NAMES = {'Value': 'value', 'Trend': 'trend', 'Anomaly': 'anomaly', 'All years': 'years'}
+
+STAT_ABBR = {'Standard deviation':'std', 'Minimum': 'min', 'Maximum':'max', 'Average':'mean',
+             '10th percentile':'p10', 'Median':'p50', '90th percentile':'p90'}
+
+
+def apply_style():
+    st.markdown(STYLE, unsafe_allow_html=True)
+    st.markdown(HIDE_GITHUB_ICON, unsafe_allow_html=True)
+
+
+def stat_options(cube, indicator, year=None):
+    """Names of the statistics of an indicator; the percentiles only where the scheme has sketches of ``year``."""
+    stats = cube.stats(indicator.replace(" ", "_"), year)
+    return [name for name in ['Average', 'Minimum', 'Maximum', 'Standard deviation',
+                              '10th percentile', 'Median', '90th percentile'] if STAT_ABBR[name] in stats]
+
+
+def stat_description(stat, level='block'):
+    """Description of a statistic of the blocks or the sections."""
+    return STAT_DESCRIPTION[stat].replace('each block', f'each {level}')
+
+
+def format_number(num):
+    return f"{num:.2f}"
+
+
+def selected_scheme():
+    """The scheme selected in this session; the first registered one before any selection."""
+    schemes = registry()
+    return schemes.get(st.session_state.get('scheme_id'), next(iter(schemes.values())))
+
+
+def select_scheme():
+    """Sidebar logo, scheme selector and title; returns the opened scheme.
+
+    Must be called inside ``st.sidebar``. A scheme's data is loaded only once
+    it is selected, and its figures are then built in the background.
+    """
+    st.logo(load_logo(LOGO_WIDE), size="large", link='https://www.un-ihe.org/', icon_image=load_logo(LOGO_SMALL))
+    schemes = registry()
+    scheme_ids = list(schemes)
+    # the widget owns the selection under a stable key; re-assigned so it survives a page switch
+    st.session_state['scheme_id'] = selected_scheme().id
+    if len(scheme_ids) > 1:
+        scheme_id = st.selectbox('Select a scheme', scheme_ids, format_func=lambda s: schemes[s].name,
+                                 key='scheme_id')
+    else:
+        scheme_id = scheme_ids[0]
+    scheme_data = open_scheme(schemes[scheme_id])
+    # with IPA_MEMORY_BUDGET_MB set, drop cached data of the process while over it
+    memory.enforce(keep=scheme_data)
+    # build every map and bar chart of the scheme once per process in the background
+    warm_up(scheme_data)
+    st.title(f'{scheme_data.scheme.name} Irrigation Performance Indicators')
+    return scheme_data
+
+
+def find_location(scheme_data, level='block'):
+    """Sidebar coordinate lookup; properties of the block or section found, or ``None``."""
+    from ipa.spatial import parse_coordinates
+
+    coordinates = st.text_input('Find a location', placeholder='lat, lon')
+    if not coordinates:
+        return None
+    point = parse_coordinates(coordinates)
+    located = scheme_data.locate(*point, level=level) if point else None
+    if located is None:
+        st.caption(f'No {level} found at this location')
+    return located
+
+
+def select_map_layer(cube, level, indicator, stat):
+    """Sidebar choice of the map layer; one of :data:`ipa.charts.MAP_LAYERS`.
+
+    For the trend layer the number of names with a significant trend is shown.
+    """
+    from ipa.trends import SIGNIFICANCE
+
+    layer = MAP_LAYER_NAMES[st.radio('Map layer', list(MAP_LAYER_NAMES), horizontal=True,
+                                     help='Value of the selected year, linear trend over all years, the '
+                                          "selected year's z-score relative to each name's own history, or "
+                                          'all years played in the map')]
+    if layer == 'trend':
+        trend = cube.trends.trend(level, indicator, stat)
+        st.caption(f"{int(trend['significant'].sum())} of {len(trend)} {level}s with a significant "
+                   f"trend (p < {SIGNIFICANCE})")
+    return layer